@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import json
+import math
+import queue
+import threading
+import time
+import urllib.parse
+
+from collections import Counter
+
+from webcommon.traffic_capture import read_capture
+
+# Set by the replay itself rather than copied from the capture
+SKIPPED_HEADERS = ('host', 'connection', 'keep-alive', 'content-length', 'transfer-encoding')
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class ReplayResult(object):
+    """ The outcome of replaying one captured request.
+    """
+    __slots__ = ('captured', 'status', 'latency', 'lag', 'error')
+
+    def __init__(self, captured, status=None, latency=None, lag=0.0, error=None):
+        self.captured = captured
+        self.status   = status
+        self.latency  = latency
+        self.lag      = lag
+        self.error    = error
+
+
+class Replayer(object):
+    """ Plays a traffic capture (see webcommon.traffic_capture) back against a
+        WSBlite server. Requests are sent when they arrived in the capture,
+        divided by speed (speed 0 sends them as fast as the workers allow),
+        on concurrency connections which are kept alive between requests.
+    """
+
+    def __init__(self, url, speed=1.0, concurrency=8, timeout=30.0, pad_missing_bodies=False):
+        parsed_url = urllib.parse.urlsplit(url)
+        self.host               = parsed_url.hostname or 'localhost'
+        self.port               = parsed_url.port or 80
+        self.base_path          = parsed_url.path.rstrip('/')
+        self.speed              = speed
+        self.concurrency        = concurrency
+        self.timeout            = timeout
+        self.pad_missing_bodies = pad_missing_bodies
+
+        self.__pending = queue.Queue(maxsize=concurrency * 2)
+        self.__results = list()
+        self.__lock    = threading.Lock()
+
+    def replay(self, captured_requests):
+        """ Replays the requests and returns a ReplayResult for each, along with
+            how long the whole replay took.
+        """
+        workers = [threading.Thread(target=self.__send_requests, daemon=True) for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+
+        replay_started = time.monotonic()
+        first_offset = None
+        for captured in captured_requests:
+            if first_offset is None:
+                first_offset = captured.offset
+
+            if self.speed > 0:
+                due = replay_started + (captured.offset - first_offset) / self.speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                due = time.monotonic()
+            self.__pending.put( (captured, due) )
+
+        for _ in workers:
+            self.__pending.put(None)
+        for worker in workers:
+            worker.join()
+
+        return (self.__results, time.monotonic() - replay_started)
+
+    def __send_requests(self):
+        connection = None
+        while True:
+            pending = self.__pending.get()
+            if pending is None:
+                break
+            (captured, due) = pending
+
+            if connection is None:
+                connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+            sent = time.monotonic()
+            try:
+                status = self.__send_request(connection, captured)
+                result = ReplayResult(captured, status, time.monotonic() - sent, max(0.0, sent - due))
+            except (OSError, http.client.HTTPException) as err:
+                connection.close()
+                connection = None
+                result = ReplayResult(captured, lag=max(0.0, sent - due), error=type(err).__name__)
+
+            with self.__lock:
+                self.__results.append(result)
+
+        if connection:
+            connection.close()
+
+    def __send_request(self, connection, captured):
+        body = captured.body
+        if body is None:
+            body = b'\0' * captured.body_size if self.pad_missing_bodies else b''
+
+        connection.putrequest(captured.method, self.base_path + captured.target,
+                              skip_host=True, skip_accept_encoding=True)
+        for name, value in captured.headers:
+            if name.lower() not in SKIPPED_HEADERS:
+                connection.putheader(name, value)
+        connection.putheader('Host', self.host + ':' + str(self.port))
+        if body or captured.method not in ('GET', 'HEAD', 'DELETE', 'OPTIONS'):
+            connection.putheader('Content-Length', str(len(body)))
+        connection.endheaders(body if body else None)
+
+        response = connection.getresponse()
+        response.read()
+        if response.will_close:
+            connection.close()
+        return response.status
+
+
+def percentile(sorted_values, percent):
+    """ The nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarise(results, duration):
+    """ Latency percentiles (in milliseconds) and the differences between the
+        status codes sent back in the capture and in the replay.
+    """
+    latencies = sorted(result.latency for result in results if result.latency is not None)
+    status_diffs = Counter((str(result.captured.status), str(result.status if result.error is None else result.error))
+                           for result in results if result.status != result.captured.status)
+
+    return {'requests': len(results),
+            'errors': sum(1 for result in results if result.error),
+            'duration_s': round(duration, 3),
+            'requests_per_s': round(len(results) / duration, 1) if duration else None,
+            'latency_ms': dict([('p' + str(percent), _to_ms(percentile(latencies, percent)))
+                                for percent in PERCENTILES] +
+                               [('max', _to_ms(latencies[-1] if latencies else None))]),
+            'max_lag_ms': _to_ms(max((result.lag for result in results), default=None)),
+            'status_codes': dict(Counter(str(result.status) for result in results if result.error is None)),
+            'status_diffs': [{'captured': captured, 'replayed': replayed, 'count': count}
+                             for ((captured, replayed), count) in status_diffs.most_common()]}
+
+
+def print_summary(summary):
+    print('Requests:     ' + str(summary['requests']) + ' in ' + str(summary['duration_s']) + 's (' +
+          str(summary['requests_per_s']) + '/s), ' + str(summary['errors']) + ' errors')
+    print('Latency (ms): ' + ', '.join(name + ' ' + str(value) for name, value in summary['latency_ms'].items()))
+    print('Max lag (ms): ' + str(summary['max_lag_ms']) + ' (how far behind the capture\'s timing sending fell)')
+    print('Status codes: ' + ', '.join(status + ' x' + str(count)
+                                      for status, count in sorted(summary['status_codes'].items())))
+    if summary['status_diffs']:
+        print('Status codes which differ from the capture:')
+        for diff in summary['status_diffs']:
+            print('  ' + diff['captured'] + ' -> ' + diff['replayed'] + ' x' + str(diff['count']))
+    else:
+        print('Every status code matches the capture')
+
+
+def _to_ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def add_parser_arguments(arg_parser):
+    arg_parser.add_argument('capture_file', type=str)
+    arg_parser.add_argument('--url', '-u', type=str, default='http://localhost:9090',
+                            help='the WSBlite server to replay the capture against')
+    arg_parser.add_argument('--speed', type=float, default=1.0,
+                            help='2 replays twice as fast as captured, 0 as fast as possible')
+    arg_parser.add_argument('--concurrency', '-c', type=int, default=8)
+    arg_parser.add_argument('--timeout', type=float, default=30.0)
+    arg_parser.add_argument('--pad_missing_bodies', action='store_true',
+                            help='send zeros in place of bodies which weren\'t captured')
+    arg_parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+
+    return arg_parser
+
+
+def main(capture_file, url='http://localhost:9090', speed=1.0, concurrency=8, timeout=30.0,
+         pad_missing_bodies=False):
+    """ Replays the capture and returns its summary (see summarise).
+    """
+    replayer = Replayer(url, speed=speed, concurrency=concurrency, timeout=timeout,
+                        pad_missing_bodies=pad_missing_bodies)
+    (results, duration) = replayer.replay(read_capture(capture_file))
+    return summarise(results, duration)
+
+
+def command_line_run():
+    args = add_parser_arguments(argparse.ArgumentParser(description='Replay captured WSBlite traffic')).parse_args()
+    summary = main(args.capture_file, url=args.url, speed=args.speed, concurrency=args.concurrency,
+                   timeout=args.timeout, pad_missing_bodies=args.pad_missing_bodies)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == '__main__':
+    command_line_run()
@@ -6,6 +6,7 @@ import os
 import importlib
 import signal
 import webservice_engine
+from webcommon import tracing
 import logging.config
 
 from time import sleep
@@ -52,6 +53,36 @@ def add_parser_arguments(arg_parser):
     arg_parser.add_argument('--common_dir', '-c', type=str)
     arg_parser.add_argument('--log_config', '-l', type=str)
     arg_parser.add_argument('--system_run', '-s', action="store_true")
+    arg_parser.add_argument('--fast_header_parsing', action="store_true")
+    arg_parser.add_argument('--header_timeout', type=float)
+    arg_parser.add_argument('--body_timeout', type=float)
+    arg_parser.add_argument('--write_timeout', type=float)
+    arg_parser.add_argument('--max_request_line_length', type=int)
+    arg_parser.add_argument('--max_header_count', type=int)
+    arg_parser.add_argument('--max_header_bytes', type=int)
+    arg_parser.add_argument('--process_pool_workers', type=int)
+    arg_parser.add_argument('--listen', action='append', dest='listen_addresses',
+                            help='host:port, :port or unix:/path to listen on instead of --port '
+                                 '(can be given more than once)')
+    arg_parser.add_argument('--backlog', type=int)
+    arg_parser.add_argument('--tcp_nodelay', action='store_true', default=None)
+    arg_parser.add_argument('--send_buffer_size', type=int)
+    arg_parser.add_argument('--receive_buffer_size', type=int)
+    arg_parser.add_argument('--trace_sample_rate', type=float, default=0.0)
+    arg_parser.add_argument('--trace_file', type=str)
+    arg_parser.add_argument('--capture_file', type=str,
+                            help='record the requests received for replay_traffic.py')
+    arg_parser.add_argument('--capture_body_sample_rate', type=float)
+    arg_parser.add_argument('--capture_max_body_bytes', type=int)
+    arg_parser.add_argument('--cors', action='store_true',
+                            help='answer CORS preflight requests and allow cross-origin requests')
+    arg_parser.add_argument('--cors_allow_origin', action='append', dest='cors_allow_origins',
+                            help='origin allowed to make cross-origin requests (default any, can be given '
+                                 'more than once)')
+    arg_parser.add_argument('--cors_allow_header', action='append', dest='cors_allow_headers')
+    arg_parser.add_argument('--cors_max_age', type=int,
+                            help='seconds browsers may cache preflight responses for')
+    arg_parser.add_argument('--cors_allow_credentials', action='store_true', default=None)
 
     return arg_parser
 
@@ -83,6 +114,44 @@ def expand_arguments(args, error_function):
               
     expanded_args['port']       = args.port
     expanded_args['system_run'] = args.system_run
+    expanded_args['fast_header_parsing'] = args.fast_header_parsing
+    expanded_args['process_pool_workers'] = args.process_pool_workers
+
+    # Only pass on the request limits given, the rest keep their defaults
+    request_limits = dict()
+    for limit in ('header_timeout', 'body_timeout', 'write_timeout', 'max_request_line_length',
+                  'max_header_count', 'max_header_bytes'):
+        if getattr(args, limit) is not None:
+            request_limits[limit] = getattr(args, limit)
+    expanded_args['request_limits'] = request_limits
+
+    expanded_args['listen_addresses'] = args.listen_addresses
+    socket_options = dict()
+    for option in ('backlog', 'tcp_nodelay', 'send_buffer_size', 'receive_buffer_size'):
+        if getattr(args, option) is not None:
+            socket_options[option] = getattr(args, option)
+    expanded_args['socket_options'] = socket_options
+
+    expanded_args['trace_sample_rate'] = args.trace_sample_rate
+    if args.trace_file:
+        expanded_args['trace_file'] = os.path.abspath(args.trace_file)
+
+    if args.capture_file:
+        traffic_capture = {'path': os.path.abspath(args.capture_file)}
+        if args.capture_body_sample_rate is not None:
+            traffic_capture['body_sample_rate'] = args.capture_body_sample_rate
+        if args.capture_max_body_bytes is not None:
+            traffic_capture['max_body_bytes'] = args.capture_max_body_bytes
+        expanded_args['traffic_capture'] = traffic_capture
+
+    cors = dict()
+    for option in ('allow_origins', 'allow_headers', 'max_age', 'allow_credentials'):
+        if getattr(args, 'cors_' + option) is not None:
+            cors[option] = getattr(args, 'cors_' + option)
+    if cors.get('allow_credentials') and '*' in cors.get('allow_origins', ('*',)):
+        error_function('--cors_allow_credentials needs the allowed origins given with --cors_allow_origin')
+    if args.cors or cors:
+        expanded_args['cors'] = cors
 
     return expanded_args
 
@@ -127,7 +196,9 @@ def import_web_services(import_from):
             
     return imported_web_services
         
-def main(port, import_dir=None, common_dir=None, log_config=None, system_run=True):
+def main(port, import_dir=None, common_dir=None, log_config=None, system_run=True, fast_header_parsing=False,
+         request_limits=None, process_pool_workers=None, listen_addresses=None, socket_options=None,
+         trace_sample_rate=0.0, trace_file=None, traffic_capture=None, cors=None):
     """ The main entry into running the web services. The command line hooks into
         this but other scripts can call this directly.
     """
@@ -156,11 +227,23 @@ def main(port, import_dir=None, common_dir=None, log_config=None, system_run=Tru
         logging.debug('Log Config: ' + log_config)
     logging.debug('Port: ' + str(port) )
     
+    if trace_sample_rate > 0:
+        # Before the web services are created so background processes trace too
+        logging.info('Tracing ' + str(trace_sample_rate * 100) + '% of requests')
+        tracing.configure(trace_sample_rate, trace_file)
+
     all_web_services = import_web_services(import_from=import_dir)
     web_services_not_to_import = import_web_services(import_from=common_dir)
     web_services_to_import = list(set(all_web_services) - set(web_services_not_to_import))
       
-    controller = webservice_engine.WebServiceController(port, web_services_to_import)
+    controller = webservice_engine.WebServiceController(port, web_services_to_import,
+                                                        fast_header_parsing=fast_header_parsing,
+                                                        request_limits=request_limits,
+                                                        process_pool_workers=process_pool_workers,
+                                                        listen_addresses=listen_addresses,
+                                                        socket_options=socket_options,
+                                                        traffic_capture=traffic_capture,
+                                                        cors=cors)
     controller.start()
     
     return controller
@@ -0,0 +1,665 @@
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import queue
+import socket
+import struct
+import threading
+
+from webcommon import tracing
+from webcommon.ipc_serialiser import QueueSerialiser
+
+# Returned by exchange when no reply arrived in time
+NO_REPLY = object()
+# Returned by exchange when the message couldn't be sent in time (the background
+# process is busy with other requests)
+NOT_SENT = object()
+
+# How long a new connection may take to prove it knows the authkey
+HANDSHAKE_TIMEOUT = 5.0
+
+
+class QueueTransport(object):
+    """ The default transport between a BaseBackgroundWebService and its
+        background process. The background process runs as a child of the
+        WebService's process and messages travel through multiprocessing queues,
+        one request at a time.
+    """
+
+    def __init__(self, background_process_class, serialiser, publish_event):
+        """ publish_event(event, data) is called for every event published by the
+            background process.
+        """
+        self._background_process_class = background_process_class
+        self._serialiser               = serialiser
+        self._send_queue               = multiprocessing.JoinableQueue()
+        self._receive_queue            = multiprocessing.JoinableQueue()
+        self._event_queue              = multiprocessing.Queue()
+
+        self.__publish_event    = publish_event
+        self.__transaction_id   = 0
+        self.__event_dispatcher = None
+        self.__request_lock     = threading.Lock()
+        self.__restart_lock     = threading.Lock()
+
+        self._background_process = self.__create_background_process()
+
+    def start(self):
+        self._serialiser.prepare()
+        self._background_process.start()
+
+        self.__event_dispatcher = threading.Thread(target=self.__dispatch_events, daemon=True)
+        self.__event_dispatcher.start()
+
+    def stop(self):
+        """ Attempts to stop the background process but terminates it if it
+            takes too long stopping the worker thread.
+        """
+        self._background_process.shutdown()
+        self._background_process.join(3)
+        if self._background_process.is_alive():
+            logging.info('Background process forced killed')
+            self._background_process.terminate()
+
+        self._event_queue.put(None)
+        if self.__event_dispatcher:
+            self.__event_dispatcher.join(2)
+
+    def is_available(self):
+        return self._background_process.is_alive()
+
+    def restart(self):
+        """ Replaces a dead or stuck background process with a new one (with fresh
+            queues, as the old process may have died holding a queue's lock).
+            Returns True if the new process was started.
+        """
+        with self.__restart_lock:
+            old_process = self._background_process
+
+            if old_process.is_alive():
+                old_process.terminate()
+            old_process.join(1)
+
+            self.__discard_queued_messages(self._send_queue)
+            self.__discard_queued_messages(self._receive_queue)
+
+            self._send_queue         = multiprocessing.JoinableQueue()
+            self._receive_queue      = multiprocessing.JoinableQueue()
+            self._background_process = self.__create_background_process()
+            try:
+                self._background_process.start()
+            except OSError:
+                logging.exception('Failed to restart background process')
+                return False
+
+            return True
+
+    def get_queue_sizes(self):
+        """ The messages waiting in each queue, None where the platform can't
+            tell.
+        """
+        return {'requests': _queue_size(self._send_queue), 'replies': _queue_size(self._receive_queue),
+                'events': _queue_size(self._event_queue)}
+
+    def get_new_transaction_id(self):
+        """ Increments the transaction ID and passes it back. This is used
+            to make sure the response from the background process matches up
+            with the right request.
+        """
+        self.__transaction_id += 1
+        return self.__transaction_id
+
+    def exchange(self, message_to_send, timeout, traceparent=None):
+        """ Sends a message to the background process and waits for its reply.
+            The traceparent lets the background process continue the trace.
+        """
+        # Only one request is in flight at a time so replies can't be taken by
+        # the wrong caller.
+        with tracing.tracer.span('wait_for_background_process'):
+            acquired = self.__request_lock.acquire(timeout=timeout)
+        if not acquired:
+            return NOT_SENT
+        try:
+            send_trans_id = self.get_new_transaction_id()
+            self._send_queue.put( (send_trans_id, self._serialiser.dumps(message_to_send), traceparent) )
+
+            try:
+                while True:
+                    (received_trans_id, message_received) = self._receive_queue.get(block=True,
+                                                                                   timeout=timeout)
+                    self._receive_queue.task_done()
+
+                    if send_trans_id == received_trans_id:
+                        return self._serialiser.loads(message_received)
+                    else:
+                        # A late reply to an earlier request which timed out
+                        self._serialiser.discard(message_received)
+                        continue
+
+            except queue.Empty:
+                pass
+
+            return NO_REPLY
+        finally:
+            self.__request_lock.release()
+
+    def __create_background_process(self):
+        background_process = self._background_process_class(self._send_queue, self._receive_queue)
+        background_process.set_event_queue(self._event_queue)
+        background_process.set_serialiser(self._serialiser)
+        return background_process
+
+    def __discard_queued_messages(self, message_queue):
+        """ Empties a queue which is being replaced so anything its messages hold
+            (e.g. shared memory) is released.
+        """
+        try:
+            while True:
+                message = message_queue.get_nowait()[1]
+                self._serialiser.discard(message)
+        except (queue.Empty, OSError, ValueError, EOFError):
+            pass
+
+    def __dispatch_events(self):
+        """ Forwards the events published by the background process until told
+            to stop.
+        """
+        while True:
+            published = self._event_queue.get()
+            if published is None:
+                break
+            (event, data) = published
+            self.__publish_event(event, data)
+
+
+def _queue_size(message_queue):
+    try:
+        return message_queue.qsize()
+    except NotImplementedError:
+        # multiprocessing queues can't report their size on macOS
+        return None
+
+
+def check_authkey(address, authkey):
+    """ Frames are pickled, so a TCP address (which anyone who can reach the
+        port could connect to) must have an authkey. Unix sockets are protected
+        by their file permissions so the authkey is optional. Returns the
+        authkey as bytes.
+    """
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    if not authkey and parse_worker_address(address)[0] != socket.AF_UNIX:
+        raise ValueError('An authkey is needed to reach background workers over TCP: ' + str(address))
+    return authkey
+
+
+def parse_worker_address(address):
+    """ Converts a worker address ('host:port', 'unix:/path/to/socket' or a
+        (host, port) tuple) into a socket family and socket address.
+    """
+    if isinstance(address, tuple):
+        return (socket.AF_INET, address)
+    if address.startswith('unix:'):
+        return (socket.AF_UNIX, address[len('unix:'):])
+
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError('Worker address must be host:port or unix:/path: ' + address)
+    host = host.strip('[]')
+    return (socket.AF_INET6 if ':' in host else socket.AF_INET, (host, int(port)))
+
+
+class FrameConnection(object):
+    """ A socket carrying length-prefixed frames, each a pickled object. Frames
+        can be sent from any thread, only one thread should receive. The
+        transports send (kind, transaction id, message, traceparent) tuples.
+
+        With an authkey both ends prove they know it (the HMAC challenge used by
+        multiprocessing.connection) before any frame is unpickled.
+    """
+
+    HEADER = struct.Struct('!I')
+
+    def __init__(self, sock):
+        self.sock = sock
+
+        self.__rfile     = sock.makefile('rb')
+        self.__send_lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, address, timeout, authkey=None):
+        """ Connects to a BackgroundProcessServer, raising OSError if it can't be
+            reached and multiprocessing.AuthenticationError if it doesn't hold the
+            same authkey.
+        """
+        family, sock_address = parse_worker_address(address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(sock_address)
+            if family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            sock.close()
+            raise
+
+        connection = cls(sock)
+        try:
+            if authkey:
+                try:
+                    multiprocessing.connection.answer_challenge(connection, authkey)
+                except AssertionError:
+                    raise multiprocessing.AuthenticationError('Worker did not send a challenge, '
+                                                              'it has no authkey')
+                multiprocessing.connection.deliver_challenge(connection, authkey)
+            sock.settimeout(None)
+        except (OSError, EOFError, multiprocessing.AuthenticationError):
+            connection.close()
+            raise
+        return connection
+
+    def accept_handshake(self, authkey, timeout):
+        """ The server's side of connect. Raises multiprocessing.AuthenticationError
+            if the client doesn't hold the authkey.
+        """
+        if authkey:
+            self.sock.settimeout(timeout)
+            multiprocessing.connection.deliver_challenge(self, authkey)
+            multiprocessing.connection.answer_challenge(self, authkey)
+            self.sock.settimeout(None)
+
+    def send(self, frame):
+        self.send_bytes(pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def receive(self):
+        """ Returns the next frame, raising EOFError once the connection has been
+            closed.
+        """
+        return pickle.loads(self.recv_bytes())
+
+    def send_bytes(self, data):
+        with self.__send_lock:
+            self.sock.sendall(b''.join((self.HEADER.pack(len(data)), data)))
+
+    def recv_bytes(self, maxlength=None):
+        header = self.__rfile.read(self.HEADER.size)
+        if len(header) < self.HEADER.size:
+            raise EOFError('Connection closed')
+        (length,) = self.HEADER.unpack(header)
+        if maxlength is not None and length > maxlength:
+            raise OSError('Frame of ' + str(length) + ' bytes is too long')
+        data = self.__rfile.read(length)
+        if len(data) < length:
+            raise EOFError('Connection closed mid-frame')
+        return data
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.__rfile.close()
+        self.sock.close()
+
+
+class BackgroundProcessServer(object):
+    """ Runs a background process as a standalone worker which can be reached by
+        BaseBackgroundWebServices on this or other machines over TCP or a Unix
+        socket (see SocketTransport). Requests from every connection are handed
+        to the background process in the order they arrive and events it
+        publishes are sent to every connection.
+
+        Frames are pickled, so clients must prove they hold the authkey before
+        anything they send is unpickled. The authkey is required for TCP
+        addresses. Even so, only listen on networks you trust (the frames
+        aren't encrypted).
+    """
+
+    def __init__(self, background_process_class, address, serialiser=None, request_timeout=30.0,
+                 authkey=None):
+        self.address         = address
+        self.request_timeout = request_timeout
+
+        self.__authkey          = check_authkey(address, authkey)
+        self.__transport        = QueueTransport(background_process_class,
+                                                 serialiser if serialiser else QueueSerialiser(),
+                                                 self.__broadcast_event)
+        self.__listener         = None
+        self.__connections      = set()
+        self.__connections_lock = threading.Lock()
+        self.__requests         = queue.Queue()
+        self.__stopping         = threading.Event()
+        self.__threads          = list()
+
+    def start(self):
+        self.__transport.start()
+
+        family, sock_address = parse_worker_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(sock_address):
+            # Left behind by a previous run
+            os.unlink(sock_address)
+
+        self.__listener = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.__listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__listener.bind(sock_address)
+        self.__listener.listen()
+        logging.info('Background process listening on ' + str(self.address))
+
+        for target in (self.__accept_connections, self.__dispatch_requests):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def serve_forever(self):
+        """ Starts the server and blocks until stop is called (or the process is
+            interrupted).
+        """
+        self.start()
+        try:
+            while not self.__stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.__stopping.is_set() and self.__listener is None:
+            return
+        self.__stopping.set()
+
+        if self.__listener:
+            try:
+                # Wakes the thread blocked in accept, close alone doesn't
+                self.__listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.__listener.close()
+            self.__listener = None
+            family, sock_address = parse_worker_address(self.address)
+            if family == socket.AF_UNIX and os.path.exists(sock_address):
+                os.unlink(sock_address)
+
+        with self.__connections_lock:
+            connections = list(self.__connections)
+            self.__connections.clear()
+        for connection in connections:
+            connection.close()
+
+        self.__requests.put(None)
+        for thread in self.__threads:
+            thread.join(2)
+        self.__transport.stop()
+
+    def get_address(self):
+        """ The address actually being listened on (useful when binding port 0).
+        """
+        if self.__listener and self.__listener.family != socket.AF_UNIX:
+            host, port = self.__listener.getsockname()[:2]
+            return host + ':' + str(port)
+        return self.address
+
+    def __accept_connections(self):
+        while not self.__stopping.is_set():
+            try:
+                sock, _ = self.__listener.accept()
+            except (OSError, AttributeError):
+                # The listener was closed by stop
+                break
+            if sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            # The handshake happens on the connection's own thread so a client
+            # which never answers can't hold up the others
+            threading.Thread(target=self.__read_requests, args=(FrameConnection(sock),), daemon=True).start()
+
+    def __read_requests(self, connection):
+        """ Queues each request received on a connection once it has
+            authenticated. Clients may send many requests without waiting for
+            the replies.
+        """
+        try:
+            connection.accept_handshake(self.__authkey, HANDSHAKE_TIMEOUT)
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as err:
+            logging.warning('Rejected background worker client: ' + repr(err))
+            connection.close()
+            return
+
+        with self.__connections_lock:
+            if self.__stopping.is_set():
+                connection.close()
+                return
+            self.__connections.add(connection)
+
+        try:
+            while True:
+                (kind, trans_id, message, traceparent) = connection.receive()
+                if kind == 'request':
+                    self.__requests.put( (connection, trans_id, message, traceparent) )
+        except (EOFError, OSError, pickle.UnpicklingError, ValueError):
+            pass
+        finally:
+            with self.__connections_lock:
+                self.__connections.discard(connection)
+            connection.close()
+
+    def __dispatch_requests(self):
+        while True:
+            queued = self.__requests.get()
+            if queued is None:
+                break
+            (connection, trans_id, message, traceparent) = queued
+
+            if not self.__transport.is_available():
+                logging.info('Background process not running, restarting it')
+                self.__transport.restart()
+
+            reply = self.__transport.exchange(message, self.request_timeout, traceparent)
+            if reply is NO_REPLY or reply is NOT_SENT:
+                # The client times the request out itself
+                logging.info('No reply from background process for request ' + str(trans_id))
+                continue
+
+            try:
+                connection.send( ('reply', trans_id, reply, None) )
+            except OSError:
+                logging.debug('Client went away before its reply was sent')
+
+    def __broadcast_event(self, event, data):
+        with self.__connections_lock:
+            connections = list(self.__connections)
+        for connection in connections:
+            try:
+                connection.send( ('event', None, (event, data), None) )
+            except OSError:
+                pass
+
+
+class _PendingReply(object):
+
+    def __init__(self):
+        self.reply    = NO_REPLY
+        self.received = threading.Event()
+
+
+class _WorkerConnection(object):
+    """ A SocketTransport's connection to a single worker, matching replies to
+        the requests waiting for them by transaction id.
+    """
+
+    def __init__(self, address, frame_connection, publish_event):
+        self.address = address
+
+        self.__frame_connection = frame_connection
+        self.__publish_event    = publish_event
+        self.__pending          = dict()
+        self.__pending_lock     = threading.Lock()
+        self.__closed           = False
+        self.__reader           = threading.Thread(target=self.__read_frames, daemon=True)
+        self.__reader.start()
+
+    @property
+    def connected(self):
+        return not self.__closed
+
+    @property
+    def pending_count(self):
+        """ The requests sent which are still waiting for a reply.
+        """
+        with self.__pending_lock:
+            return len(self.__pending)
+
+    def exchange(self, trans_id, message_to_send, timeout, traceparent=None):
+        pending = _PendingReply()
+        with self.__pending_lock:
+            if self.__closed:
+                return NOT_SENT
+            self.__pending[trans_id] = pending
+
+        try:
+            self.__frame_connection.send( ('request', trans_id, message_to_send, traceparent) )
+        except OSError:
+            self.close()
+            return NO_REPLY
+
+        if not pending.received.wait(timeout):
+            with self.__pending_lock:
+                self.__pending.pop(trans_id, None)
+        return pending.reply
+
+    def close(self):
+        """ Closes the connection, failing every request still waiting.
+        """
+        with self.__pending_lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            pending_replies = list(self.__pending.values())
+            self.__pending.clear()
+
+        self.__frame_connection.close()
+        for pending in pending_replies:
+            pending.received.set()
+
+    def __read_frames(self):
+        try:
+            while True:
+                (kind, trans_id, message, traceparent) = self.__frame_connection.receive()
+                if kind == 'reply':
+                    with self.__pending_lock:
+                        pending = self.__pending.pop(trans_id, None)
+                    if pending is not None:
+                        pending.reply = message
+                        pending.received.set()
+                elif kind == 'event':
+                    (event, data) = message
+                    self.__publish_event(event, data)
+        except (EOFError, OSError, pickle.UnpicklingError, ValueError):
+            if not self.__closed:
+                logging.info('Lost connection to background worker ' + str(self.address))
+        finally:
+            self.close()
+
+
+class SocketTransport(object):
+    """ Reaches background processes running as standalone workers (see
+        BackgroundProcessServer) over TCP or Unix sockets. Requests are spread
+        round-robin over the connected workers and several requests can be in
+        flight on a connection at once, each reply being matched up with its
+        request by transaction id. Lost connections are re-established in the
+        background.
+    """
+
+    def __init__(self, addresses, publish_event, connect_timeout=2.0, reconnect_interval=1.0,
+                 authkey=None):
+        """ authkey must match the workers' (see BackgroundProcessServer), it's
+            required if any of the addresses is a TCP one.
+        """
+        if not addresses:
+            raise ValueError('At least one worker address is needed')
+
+        self.addresses          = list(addresses)
+        self.connect_timeout    = connect_timeout
+        self.reconnect_interval = reconnect_interval
+
+        for address in self.addresses:
+            authkey = check_authkey(address, authkey)
+        self.__authkey        = authkey
+        self.__publish_event  = publish_event
+        self.__connections    = dict.fromkeys(self.addresses)
+        self.__connect_lock   = threading.Lock()
+        self.__next_worker    = itertools.count()
+        self.__transaction_id = itertools.count(1)
+        self.__stopping       = threading.Event()
+        self.__reconnector    = None
+
+    def start(self):
+        self.__stopping.clear()
+        self.__connect_missing()
+        self.__reconnector = threading.Thread(target=self.__reconnect_periodically, daemon=True)
+        self.__reconnector.start()
+
+    def stop(self):
+        self.__stopping.set()
+        if self.__reconnector:
+            self.__reconnector.join(2)
+        with self.__connect_lock:
+            connections = [connection for connection in self.__connections.values() if connection]
+            self.__connections = dict.fromkeys(self.addresses)
+        for connection in connections:
+            connection.close()
+
+    def is_available(self):
+        return bool(self.__connected_workers())
+
+    def restart(self):
+        """ Tries to reconnect to every worker which isn't connected straight
+            away. Returns True if at least one worker is connected.
+        """
+        self.__connect_missing()
+        return self.is_available()
+
+    def get_queue_sizes(self):
+        """ The requests waiting for a reply from each connected worker.
+        """
+        return {'requests': {str(connection.address): connection.pending_count
+                             for connection in self.__connected_workers()}}
+
+    def exchange(self, message_to_send, timeout, traceparent=None):
+        connected = self.__connected_workers()
+        if not connected:
+            return NO_REPLY
+        connection = connected[next(self.__next_worker) % len(connected)]
+        return connection.exchange(next(self.__transaction_id), message_to_send, timeout, traceparent)
+
+    def __connected_workers(self):
+        return [connection for connection in list(self.__connections.values())
+                if connection and connection.connected]
+
+    def __connect_missing(self):
+        with self.__connect_lock:
+            for address, connection in self.__connections.items():
+                if self.__stopping.is_set():
+                    break
+                if connection and connection.connected:
+                    continue
+                try:
+                    frame_connection = FrameConnection.connect(address, self.connect_timeout, self.__authkey)
+                except multiprocessing.AuthenticationError as err:
+                    logging.warning('Background worker ' + str(address) + ' rejected the authkey: ' + str(err))
+                    continue
+                except (OSError, EOFError) as err:
+                    logging.debug('Cannot connect to background worker ' + str(address) + ': ' + str(err))
+                    continue
+                logging.info('Connected to background worker ' + str(address))
+                self.__connections[address] = _WorkerConnection(address, frame_connection,
+                                                                 self.__publish_event)
+
+    def __reconnect_periodically(self):
+        while not self.__stopping.wait(self.reconnect_interval):
+            if len(self.__connected_workers()) < len(self.addresses):
+                self.__connect_missing()
@@ -4,8 +4,20 @@ import threading
 import queue
 import logging
 
-from time import sleep
-from webcommon.base_webservice import BaseWebService
+from webcommon import diagnostics, tracing
+from webcommon.background_transport import NO_REPLY, NOT_SENT, QueueTransport, SocketTransport
+from webcommon.base_webservice import BaseWebService, ServiceUnavailableError
+from webcommon.circuit_breaker import CircuitBreaker
+from webcommon.event_stream import EventStream
+from webcommon.ipc_serialiser import QueueSerialiser
+from webcommon.scheduler import TaskScheduler
+
+
+class BackgroundProcessUnavailable(ServiceUnavailableError):
+    """ Raised by BaseBackgroundWebService.request when the background process
+        is dead or has stopped responding (the circuit breaker is open).
+    """
+    pass
 
 
 class BaseBackgroundWebService(BaseWebService):
@@ -29,6 +41,9 @@ class BaseBackgroundWebService(BaseWebService):
             
             self.__receive_queue  = receive_queue
             self.__send_queue     = send_queue
+            self.__event_queue    = None
+            self.__serialiser     = QueueSerialiser()
+            self.__scheduler      = TaskScheduler()
             self.__worker_process = threading.Thread(target=self.main_loop)
     
         def run(self):
@@ -45,7 +60,8 @@ class BaseBackgroundWebService(BaseWebService):
             while not self.exit_flag.is_set():
                 self.wait_for_request()
                     
-            
+            # Stop the worker waiting for its next scheduled task
+            self.__scheduler.wake()
             self.__worker_process.join(2)
             
             logging.debug('BaseBackgroundProcess Exiting')
@@ -65,8 +81,17 @@ class BaseBackgroundWebService(BaseWebService):
 
             self.initialise()
 
-            while not self.exit_flag.is_set():
-                self.loop()
+            if type(self).loop is not BaseBackgroundWebService.BaseBackgroundProcess.loop:
+                while not self.exit_flag.is_set():
+                    self.loop()
+                    self.__scheduler.run_due_tasks()
+            else:
+                # Nothing to do but the scheduled tasks so sleep until the next is due
+                while not self.exit_flag.is_set():
+                    next_due = self.__scheduler.run_due_tasks()
+                    if self.exit_flag.is_set():
+                        break
+                    self.__scheduler.wait(next_due)
 
             self.deinitialise()
 
@@ -78,9 +103,31 @@ class BaseBackgroundWebService(BaseWebService):
                 It is fine if the work you need to carry out blocks (so it doesn't
                 exit from this method) but this may cause it to be terminated 
                 with no notice on exit. 
+
+                If your work needs doing periodically use schedule_interval or
+                schedule_fixed_rate instead. If loop isn't overridden the worker
+                thread sleeps until the next scheduled task is due rather than
+                spinning.
             """
             pass
 
+        def schedule_interval(self, interval, task, *args, initial_delay=None):
+            """ Calls task(*args) on the worker thread every interval seconds,
+                measured from the end of the previous call. Returns a ScheduledTask
+                which can be cancelled. You should not overload this method.
+            """
+            return self.__scheduler.schedule(interval, task, args, fixed_rate=False,
+                                             initial_delay=initial_delay)
+
+        def schedule_fixed_rate(self, interval, task, *args, initial_delay=None):
+            """ Calls task(*args) on the worker thread every interval seconds,
+                measured from when the task was first due so that it doesn't drift.
+                Returns a ScheduledTask which can be cancelled. You should not
+                overload this method.
+            """
+            return self.__scheduler.schedule(interval, task, args, fixed_rate=True,
+                                             initial_delay=initial_delay)
+
         def deinitialise(self):
             """ Override this method if your BackgroundProcess needs to release any
                 resources before it exits.
@@ -92,8 +139,22 @@ class BaseBackgroundWebService(BaseWebService):
                 WebService. You should not overload this method. 
             """
             try:  
-                (received_trans_id, message_received) = self.__receive_queue.get(block=True, timeout=2)
-                message_to_send = self.handle_request(message_received)
+                (received_trans_id, message_received, traceparent) = self.__receive_queue.get(block=True,
+                                                                                              timeout=2)
+                if received_trans_id is None:
+                    # Sent by shutdown to stop us waiting
+                    self.__receive_queue.task_done()
+                    return
+                # Continue the trace of the request which sent the message, if any
+                span = tracing.tracer.start_trace('handle_request', traceparent) if traceparent else tracing.NOOP_SPAN
+                with span:
+                    message_received = self.__serialiser.loads(message_received)
+                    if isinstance(message_received, diagnostics.ProcessStatsRequest):
+                        # Answered for every background process, not passed on to handle_request
+                        message_to_send = message_received.perform()
+                    else:
+                        message_to_send = self.handle_request(message_received)
+                    message_to_send = self.__serialiser.dumps(message_to_send)
                 self.__send_queue.put( (received_trans_id, message_to_send) )
                 self.__receive_queue.task_done()
                 self.__send_queue.join()
@@ -110,6 +171,32 @@ class BaseBackgroundWebService(BaseWebService):
             """
             return None
         
+        def set_event_queue(self, event_queue):
+            """ Sets the queue used to publish events back to the WebService.
+                This is called by the WebService before the process is started
+                - you should not overload this method.
+            """
+            self.__event_queue = event_queue
+
+        def set_serialiser(self, serialiser):
+            """ Sets how messages are serialised between the WebService and this
+                process (see webcommon.ipc_serialiser). This is called by the
+                WebService before the process is started - you should not overload
+                this method.
+            """
+            self.__serialiser = serialiser
+
+        def publish(self, data, event=None):
+            """ Publishes an event to every client subscribed to the WebService's
+                event stream. Only a single message is sent to the WebService
+                regardless of how many clients are subscribed. You should not
+                overload this method.
+            """
+            if self.__event_queue is None:
+                logging.debug('No event queue set, dropping published event')
+                return
+            self.__event_queue.put( (event, data) )
+
         def stop(self):
             """ Overload this method to be notified when the background process
                 should end.
@@ -124,8 +211,9 @@ class BaseBackgroundWebService(BaseWebService):
                 instead).
             """
             self.exit_flag.set()
+            self.__receive_queue.put( (None, None, None) )
             self.stop()
-            sleep(2)
+            self.join(2)
             if self.__worker_process.is_alive():
                 logging.debug('Worker process forced kill')
                 self.__worker_process.terminate()
@@ -133,26 +221,58 @@ class BaseBackgroundWebService(BaseWebService):
     
     
     
-    def __init__(self, web_service_config, background_process_class=None):
+    # Optional configuration items for the event stream.
+    CONF_ITM_EVENT_HEARTBEAT  = 'event_heartbeat_interval'
+    CONF_ITM_EVENT_MAX_BUFFER = 'event_max_buffered'
+
+    # Optional configuration items for detecting an unresponsive background process.
+    CONF_ITM_BREAKER_THRESHOLD = 'breaker_failure_threshold'
+    CONF_ITM_BREAKER_RESET     = 'breaker_reset_timeout'
+    CONF_ITM_AUTO_RESTART      = 'auto_restart'
+
+    # Optional configuration items for reaching background processes running as
+    # standalone workers (see webcommon.background_transport) instead of a child
+    # process. The addresses are a list of 'host:port' or 'unix:/path' strings,
+    # the authkey (required for 'host:port' addresses) must match the workers'.
+    CONF_ITM_WORKER_ADDRESSES       = 'worker_addresses'
+    CONF_ITM_WORKER_CONNECT_TIMEOUT = 'worker_connect_timeout'
+    CONF_ITM_WORKER_AUTHKEY         = 'worker_authkey'
+
+    def __init__(self, web_service_config, background_process_class=None, serialiser=None):
+        """ The serialiser decides how messages travel to and from the background
+            process. By default they are pickled by the queue, pass a
+            webcommon.ipc_serialiser.SharedMemorySerialiser if your messages are
+            large.
+        """
         super().__init__(web_service_config)
+
+        if self.use_process_pool:
+            # The background process is what does the heavy lifting here
+            logging.warning(self.service_name + ' cannot use the process pool as it has a background process')
+            self.use_process_pool = False
+
+        self._serialiser = serialiser if serialiser else QueueSerialiser()
+
+        self.auto_restart = web_service_config.get(self.CONF_ITM_AUTO_RESTART, 'false').lower() == 'true'
+        self._circuit_breaker = CircuitBreaker(
+            failure_threshold=int(web_service_config.get(self.CONF_ITM_BREAKER_THRESHOLD, 3)),
+            reset_timeout=float(web_service_config.get(self.CONF_ITM_BREAKER_RESET, 5)))
+
+        self.event_stream = EventStream(
+            max_buffered_events=int(web_service_config.get(self.CONF_ITM_EVENT_MAX_BUFFER, 64)),
+            heartbeat_interval=float(web_service_config.get(self.CONF_ITM_EVENT_HEARTBEAT, 15)))
         
-        self._send_queue         = multiprocessing.JoinableQueue()
-        self._receive_queue      = multiprocessing.JoinableQueue()
-        self.__transaction_id    = 0
-        
-        if not background_process_class:
-            background_process_class = self.BackgroundProcess
-        
-        self._background_process = background_process_class(self._send_queue, self._receive_queue)
-        
-    def get_new_transaction_id(self):
-        """ Increments the transaction ID and passes it back. This is used
-            internally to make sure the response from the background process 
-            matches up with the right request. You should not override this
-            method.
-        """
-        self.__transaction_id += 1
-        return self.__transaction_id
+        worker_addresses = web_service_config.get(self.CONF_ITM_WORKER_ADDRESSES)
+        if worker_addresses:
+            # The background process runs elsewhere, so no class is needed here
+            self._transport = SocketTransport(
+                worker_addresses, self.__publish_event,
+                connect_timeout=float(web_service_config.get(self.CONF_ITM_WORKER_CONNECT_TIMEOUT, 2)),
+                authkey=web_service_config.get(self.CONF_ITM_WORKER_AUTHKEY))
+        else:
+            if not background_process_class:
+                background_process_class = self.BackgroundProcess
+            self._transport = QueueTransport(background_process_class, self._serialiser, self.__publish_event)
     
     def request(self, message_to_send, timeout=2):
         """ Makes a request to the background process with a message you provide.
@@ -160,46 +280,111 @@ class BaseBackgroundWebService(BaseWebService):
             the mesaage passed in. You can use this to return the requested info
             asked by a client from your background process or to carry out an
             operation on the background process (you define).  
+
+            None is returned if the background process doesn't reply in time.
+            After several of these in a row (or if the process has died) the
+            circuit breaker opens and BackgroundProcessUnavailable is raised
+            straight away instead, which the client sees as a 503.
         """
-        send_trans_id = self.get_new_transaction_id()
-        self._send_queue.put( (send_trans_id, message_to_send) )
-        self._send_queue.join()
-        
+        if not self._circuit_breaker.allow_request():
+            raise BackgroundProcessUnavailable(self.service_name + ' background process is unavailable',
+                                               retry_after=self._circuit_breaker.retry_after())
+
+        # Whatever happens the breaker must hear how this request went, otherwise
+        # a half-open breaker would wait forever on this probe.
+        outcome_recorded = False
         try:
-            while True:
-                (received_trans_id, message_received) = self._receive_queue.get(block=True, 
-                                                                               timeout=timeout)
-                self._receive_queue.task_done()
-                
-                if send_trans_id == received_trans_id:
-                    return message_received
-                else:
-                    continue
-                    
-        except queue.Empty:
-            pass
-            
-        return None
+            if not self.is_background_process_alive():
+                if not (self.auto_restart and self.restart_background_process()):
+                    self._circuit_breaker.trip()
+                    outcome_recorded = True
+                    raise BackgroundProcessUnavailable(self.service_name + ' background process is not running',
+                                                       retry_after=self._circuit_breaker.retry_after())
+
+            with tracing.tracer.span('background_request') as span:
+                message_received = self._transport.exchange(message_to_send, timeout, span.traceparent)
+
+            if message_received is NOT_SENT:
+                # Still busy with earlier requests, which doesn't mean it's stuck
+                return None
+
+            if message_received is NO_REPLY:
+                logging.info('No reply from background process of ' + self.service_name)
+                self._circuit_breaker.record_failure()
+                outcome_recorded = True
+                if self.auto_restart and self._circuit_breaker.state == CircuitBreaker.OPEN:
+                    # The process is alive but stuck
+                    self.restart_background_process()
+                return None
+
+            self._circuit_breaker.record_success()
+            outcome_recorded = True
+            return message_received
+        finally:
+            if not outcome_recorded:
+                self._circuit_breaker.release_probe()
+
+    def is_background_process_alive(self):
+        """ True if the background process is running (or, for standalone
+            workers, at least one is connected).
+        """
+        return self._transport.is_available()
+
+    def restart_background_process(self):
+        """ Replaces a dead or stuck background process with a new one (for
+            standalone workers, reconnects to them). Returns True if the
+            background process is available again.
+        """
+        logging.info('Restarting background process of ' + self.service_name)
+        return self._transport.restart()
+
+    def get_process_stats(self, limit=10, tracemalloc_action=None, timeout=2, tracemalloc_frames=1):
+        """ Asks the background process for its memory statistics (see
+            webcommon.diagnostics.process_stats), optionally starting (keeping
+            tracemalloc_frames frames of each traceback) or stopping tracemalloc
+            in it first. Returns None if it isn't running or doesn't
+            reply in time. This goes around the circuit breaker, so diagnostics
+            neither count against the background process nor are refused when
+            the breaker is open.
+        """
+        if not self.is_background_process_alive():
+            return None
+        reply = self._transport.exchange(diagnostics.ProcessStatsRequest(limit, tracemalloc_action,
+                                                                         tracemalloc_frames), timeout)
+        if reply is NO_REPLY or reply is NOT_SENT:
+            return None
+        return reply
+
+    def get_queue_sizes(self):
+        """ The number of messages waiting between the web service and its
+            background process, and the number of clients subscribed to its
+            events.
+        """
+        queue_sizes = self._transport.get_queue_sizes()
+        queue_sizes['event_subscribers'] = self.event_stream.subscriber_count()
+        return queue_sizes
+
+    def subscribe_to_events(self):
+        """ Returns a response which keeps the client's connection open and
+            streams every event published by the background process to it as
+            Server-Sent Events. Return this from perform_request.
+        """
+        return self.event_stream.subscribe()
     
     
     def start(self):
         """ Starts the background process.
         """
         logging.info('BaseBackgroundWebService Start')
-        
-        self._background_process.start()
+        self._transport.start()
     
     def stop(self):
         """ Attempts to stop the background process but terminates it if it
             takes too long stopping the worker thread.
         """
         logging.info('BaseBackgroundWebService Stop')
-        self._background_process.shutdown()
-        self._background_process.join(3)
-        if self._background_process.is_alive():
-            logging.info('Background process forced killed')
-            self._background_process.terminate()
+        self._transport.stop()
+        self.event_stream.close()
 
-        
-        
-        
\ No newline at end of file
+    def __publish_event(self, event, data):
+        self.event_stream.publish(data, event=event)
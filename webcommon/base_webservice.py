@@ -2,8 +2,24 @@
 import logging
 import base64
 import os
+import hashlib
+import types
 from http import HTTPStatus
 
+class ServiceUnavailableError(Exception):
+    """ Raised by a WebService when it can't handle a request right now. The
+        controller answers the client with a 503, telling it when to retry.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Keeps retry_after when raised inside a process pool worker
+        return (self.__class__, (str(self), self.retry_after))
+
+
 class BaseWebService(object):
     """ The BaseWebService contains all of the boilerplate code common to all
         derived WebServices so that those services can just worry about their 
@@ -17,52 +33,173 @@ class BaseWebService(object):
         """ Encapsulates the response back to the client such as the data to send
             back as well as the HTTP response code, content type etc.
         """
+        __slots__ = ('payload', 'resp_code', 'content_type', 'add_headers', 'etag')
+
+        # Responses with these codes must never carry a body.
+        BODYLESS_RESP_CODES = (HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED)
+
+        # Encoding used for payloads given as a str.
+        PAYLOAD_ENCODING = 'utf-8'
         
         def __init__(self, payload=None, resp_code=HTTPStatus.OK, add_headers=None,
-                     add_html_wrapper=True, content_type='text/html'):
+                     add_html_wrapper=True, content_type='text/html', etag=None):
             """ Creates a ServiceResponse determined by the data passed to it
                 at initialisation. For example, passing no payload means one is
-                generated automatically from the HTTP response code given.
+                generated automatically from the HTTP response code given. The
+                payload is always held as bytes ready to be written to the client.
             """
-            # TODO: Refactor this class, it's a bit messy
-             
-            # Payload
-            if payload != None:
-                self.payload = payload
+            resp_code = self.to_http_status(resp_code)
+            if resp_code in self.BODYLESS_RESP_CODES:
+                payload = b''
             else:
-                self.payload = ''
-                
-            # Response Code
-            self.resp_code = resp_code
-            
-            if not self.payload:
-                self.payload = self.resp_code.phrase + ' - ' + self.resp_code.description
-                
-            if add_html_wrapper:
-                self.payload = "<html>" + self.payload + "</html>"
-            if 'text/html' == content_type:
-                self.payload = self.payload.encode()
-            
-            
+                if not payload:
+                    if isinstance(resp_code, HTTPStatus):
+                        payload = resp_code.phrase + ' - ' + resp_code.description
+                    else:
+                        payload = str(resp_code)
+
+                if isinstance(payload, str):
+                    if add_html_wrapper:
+                        payload = ''.join(('<html>', payload, '</html>'))
+                    payload = payload.encode(self.PAYLOAD_ENCODING)
+                    if content_type.startswith('text/') and 'charset=' not in content_type:
+                        content_type += '; charset=' + self.PAYLOAD_ENCODING
+                elif add_html_wrapper:
+                    payload = b''.join((b'<html>', payload, b'</html>'))
+
+            self.payload      = payload
+            self.resp_code    = resp_code
             self.content_type = content_type
-            
-            # Response Code
-            self.resp_code = resp_code
-            
-            if not self.payload:
-                self.payload = self.resp_code[1] + ' - ' + self.resp_code[2]
-            
-            # Headers
-            if add_headers:
-                self.add_headers = add_headers
-            else:
-                self.add_headers = dict()
-                
-    
+            self.add_headers  = add_headers if add_headers is not None else dict()
+            # Strong entity tag, see BaseWebService.make_etag
+            self.etag         = etag
+
+        @staticmethod
+        def to_http_status(resp_code):
+            """ Response codes may be given as plain ints, they're held as
+                HTTPStatus members (unless the code isn't a standard one).
+            """
+            try:
+                return HTTPStatus(resp_code)
+            except ValueError:
+                return int(resp_code)
+
+        def get_headers(self):
+            """ Returns the headers to send with this response as a list of
+                (name, value) pairs, including any additional headers requested.
+            """
+            headers = list()
+            if self.payload:
+                headers.append(('Content-type', self.content_type))
+                headers.append(('Content-Length', len(self.payload)))
+            if self.etag:
+                headers.append(('ETag', self.etag))
+            headers.extend(self.add_headers.items())
+            return headers
+
+    class FrozenServiceResponse(ServiceResponse):
+        """ A ServiceResponse which cannot be changed once created. These are
+            built once and shared between requests for the common error statuses
+            (see BaseWebService.RESPONSE_NOT_FOUND etc.)
+
+            A successful one is tagged with its ETag as it's built, as it can't
+            be tagged later when a request is answered with it.
+        """
+        __slots__ = ()
+
+        def __init__(self, payload=None, resp_code=HTTPStatus.OK, add_headers=None,
+                     add_html_wrapper=True, content_type='text/html', etag=None):
+            super().__init__(payload, resp_code, types.MappingProxyType(dict(add_headers or {})),
+                             add_html_wrapper, content_type, etag)
+            if self.etag is None and self.resp_code == HTTPStatus.OK and self.payload:
+                object.__setattr__(self, 'etag', BaseWebService.make_etag(self.payload))
+
+        def __setattr__(self, name, value):
+            if hasattr(self, name):
+                raise AttributeError('FrozenServiceResponse cannot be modified')
+            super().__setattr__(name, value)
+
+        def __delattr__(self, name):
+            raise AttributeError('FrozenServiceResponse cannot be modified')
+
+        def __reduce__(self):
+            # The payload is already built so is passed back as it is
+            return (self.__class__, (self.payload, self.resp_code, dict(self.add_headers), False,
+                                     self.content_type, self.etag))
+
+    class StreamingServiceResponse(ServiceResponse):
+        """ A ServiceResponse whose body is produced piece by piece rather than
+            held in memory, for example a long-lived event stream. The handler
+            writes each chunk to the client as soon as it is produced.
+        """
+        __slots__ = ('content_length', '__chunks')
+
+        def __init__(self, chunks, resp_code=HTTPStatus.OK, add_headers=None,
+                     content_type='application/octet-stream', content_length=None):
+            """ Creates a StreamingServiceResponse from an iterable of bytes. If
+                the content_length is not known up front the client reads until
+                the connection is closed. A content_type of None sends no
+                Content-type header.
+            """
+            self.payload        = None
+            self.resp_code      = self.to_http_status(resp_code)
+            self.content_type   = content_type
+            self.content_length = content_length
+            self.add_headers    = add_headers if add_headers is not None else dict()
+            self.etag           = None
+
+            self.__chunks = chunks
+
+        def get_headers(self):
+            headers = [('Content-type', self.content_type)] if self.content_type else list()
+            if self.content_length is not None:
+                headers.append(('Content-Length', self.content_length))
+            headers.extend(self.add_headers.items())
+            return headers
+
+        def close(self):
+            """ Releases the body without producing it (e.g. when answering a
+                HEAD request).
+            """
+            if hasattr(self.__chunks, 'close'):
+                self.__chunks.close()
+
+        def iter_chunks(self):
+            """ Yields the body of the response as bytes. Closing the returned
+                iterator lets the producer release anything it holds.
+            """
+            chunks = iter(self.__chunks)
+            try:
+                for chunk in chunks:
+                    yield chunk
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+
+    # Prebuilt responses for the common error statuses, shared by every request.
+    RESPONSE_BAD_REQUEST           = FrozenServiceResponse(resp_code=HTTPStatus.BAD_REQUEST)
+    RESPONSE_NOT_FOUND             = FrozenServiceResponse(resp_code=HTTPStatus.NOT_FOUND)
+    RESPONSE_METHOD_NOT_ALLOWED    = FrozenServiceResponse(resp_code=HTTPStatus.METHOD_NOT_ALLOWED)
+    RESPONSE_INTERNAL_SERVER_ERROR = FrozenServiceResponse(resp_code=HTTPStatus.INTERNAL_SERVER_ERROR)
+    RESPONSE_SERVICE_UNAVAILABLE   = FrozenServiceResponse(resp_code=HTTPStatus.SERVICE_UNAVAILABLE)
+
     # Configuration item keys used to drill down into the WebService config.
     CONF_ITM_NAME       = 'service_name'
     CONF_ITM_OWNED_URLS = 'owned_urls'
     CONF_ITM_ENABLED    = 'service_enabled'
+    CONF_ITM_AUTO_ETAG  = 'auto_etag'
+    # Perform requests in the controller's shared process pool (see README)
+    CONF_ITM_PROCESS_POOL = 'process_pool'
+
+    # HTTP methods which can be allowed for an owned url. HEAD is allowed
+    # wherever GET is, and OPTIONS is answered by the controller unless a web
+    # service allows it itself.
+    HTTP_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+
+    # HEAD requests are performed as GET requests (the body is then left out)
+    # unless this is True, in which case perform_request sees the HEAD request
+    # and can skip generating the body.
+    handles_head_requests = False
 
     # Owned URLs
     CONF_ITM_ALLOW_METH      = 'allowed_methods'
@@ -77,6 +214,8 @@ class BaseWebService(object):
     
     def __init__(self, web_service_config):
         self.__web_service_config = web_service_config
+        # Set by the controller, see webcommon.service_bus
+        self.service_bus          = None
         
         self.populate_web_service_with_config(self.__web_service_config)
         
@@ -103,6 +242,18 @@ class BaseWebService(object):
             # Default to enabled to honour auth info if entered for a given owned url
             self.auth_all_enabled = True
 
+        # Conditional GET
+        if self.CONF_ITM_AUTO_ETAG in config:
+            self.auto_etag = config[self.CONF_ITM_AUTO_ETAG].lower() == 'true'
+        else:
+            self.auto_etag = True
+
+        # Process pool
+        if self.CONF_ITM_PROCESS_POOL in config:
+            self.use_process_pool = config[self.CONF_ITM_PROCESS_POOL].lower() == 'true'
+        else:
+            self.use_process_pool = False
+
         
     def initialise(self, web_service_lookup):
         """ This method is called just before the start method. The lookup created
@@ -124,11 +275,60 @@ class BaseWebService(object):
         """
         pass
     
-    def perform_client_request(self, handler, method, path, headers, payload_type, payload_content):
+    def perform_request(self, request):
         """ Called when a client performs a request with a url path that matches
             the one this WebService registered. The HTTP method used by the client
-            must also match the allowed methods by this WebService.
+            must also match the allowed methods by this WebService. The request
+            is a webcommon.request.Request.
+
+            By default this calls perform_client_request so that WebServices
+            written against the older signature carry on working.
+        """
+        return self.perform_client_request(request.handler, request.method, request.target, request.headers,
+                                           request.payload_type, request.payload_content)
+
+    def perform_client_request(self, handler, method, path, headers, payload_type, payload_content):
+        """ Older form of perform_request taking the request as separate
+            arguments. Override perform_request instead in new WebServices.
+        """
+        return None
+
+    @staticmethod
+    def make_etag(version):
+        """ Creates a strong entity tag from either the bytes of a payload or a
+            cheap version token (any value that changes whenever the payload would).
+        """
+        if not isinstance(version, bytes):
+            version = str(version).encode()
+        # sha1 rather than blake2b, which needs Python 3.6
+        return '"' + hashlib.sha1(version).hexdigest() + '"'
+
+    @staticmethod
+    def etag_matches(etag, headers):
+        """ Checks whether the client's If-None-Match header contains the given
+            entity tag i.e. the client already holds the current representation.
+        """
+        if_none_match = headers.get('If-None-Match') if headers else None
+        if not if_none_match or not etag:
+            return False
+
+        for candidate in if_none_match.split(','):
+            candidate = candidate.strip()
+            if candidate.startswith('W/'):
+                candidate = candidate[2:]
+            if candidate == '*' or candidate == etag:
+                return True
+
+        return False
+
+    def check_not_modified(self, headers, version):
+        """ Allows a service to skip building its payload when a cheap version
+            token shows the client is already up to date. Returns a bodyless 304
+            response if so, otherwise None.
         """
+        etag = self.make_etag(version)
+        if self.etag_matches(etag, headers):
+            return self.ServiceResponse(resp_code=HTTPStatus.NOT_MODIFIED, etag=etag)
         return None
 
     def request_authentication(self, realm):
@@ -141,11 +341,13 @@ class BaseWebService(object):
         """ Creates a dictionary holding the HTTP methods as keys with a list
             of url paths that this WebService owns as values.
         """
-        allowed_http_methods = { 'GET' : list(), 'POST' : list(), 'PUT' : list(), 'DELETE' : list() }
+        allowed_http_methods = {http_method: list() for http_method in self.HTTP_METHODS}
         for url, url_config in self.owned_urls.items():
             allowed_for_this_url = url_config[self.CONF_ITM_ALLOW_METH]
             for http_method in allowed_for_this_url:
                 allowed_http_methods[http_method].append(url)
+            if 'GET' in allowed_for_this_url and 'HEAD' not in allowed_for_this_url:
+                allowed_http_methods['HEAD'].append(url)
 
         return allowed_http_methods
 
@@ -0,0 +1,90 @@
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """ Stops callers waiting on something which has stopped responding. After
+        a number of consecutive failures the breaker opens and every call is
+        rejected straight away. Once the reset timeout has passed a single call
+        is let through as a probe (half-open) - if it succeeds the breaker closes
+        again, otherwise it re-opens for another reset timeout.
+    """
+
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=5.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout     = reset_timeout
+
+        self.__state           = self.CLOSED
+        self.__failures        = 0
+        self.__opened_at       = 0.0
+        self.__probe_in_flight = False
+        self.__lock            = threading.Lock()
+
+    @property
+    def state(self):
+        with self.__lock:
+            return self.__state
+
+    def retry_after(self):
+        """ Seconds until the next probe will be let through.
+        """
+        with self.__lock:
+            if self.__state == self.CLOSED:
+                return 0
+            return max(0.0, self.__opened_at + self.reset_timeout - time.monotonic())
+
+    def allow_request(self):
+        """ Returns True if the caller may go ahead, False if it should be
+            rejected without trying.
+        """
+        with self.__lock:
+            if self.__state == self.CLOSED:
+                return True
+
+            if self.__state == self.OPEN:
+                if time.monotonic() < self.__opened_at + self.reset_timeout:
+                    return False
+                self.__state = self.HALF_OPEN
+                self.__probe_in_flight = False
+
+            # Half-open, only one probe at a time
+            if self.__probe_in_flight:
+                return False
+            self.__probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.__lock:
+            self.__state           = self.CLOSED
+            self.__failures        = 0
+            self.__probe_in_flight = False
+
+    def record_failure(self):
+        with self.__lock:
+            self.__failures += 1
+            if self.__state == self.HALF_OPEN or self.__failures >= self.failure_threshold:
+                self.__open()
+
+    def release_probe(self):
+        """ Lets another probe through without counting the current one either
+            way, for calls which ended without finding out whether the other side
+            is working (e.g. they never got to send anything).
+        """
+        with self.__lock:
+            self.__probe_in_flight = False
+
+    def trip(self):
+        """ Opens the breaker straight away, e.g. when the other side is known to
+            be dead.
+        """
+        with self.__lock:
+            self.__open()
+
+    def __open(self):
+        self.__state           = self.OPEN
+        self.__opened_at       = time.monotonic()
+        self.__probe_in_flight = False
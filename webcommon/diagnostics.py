@@ -0,0 +1,133 @@
+import gc
+import os
+import sys
+import threading
+import traceback
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Frames from these files are tracemalloc's own bookkeeping, not the application's
+_IGNORED_ALLOCATIONS = (tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                        tracemalloc.Filter(False, '<unknown>'))
+
+
+class ProcessStatsRequest(object):
+    """ Sent to a background process (through BaseBackgroundWebService.request)
+        to have it report its own memory statistics instead of passing the
+        message to handle_request. tracemalloc_action may also be 'start' or
+        'stop' to turn allocation tracing on or off in the background process
+        first.
+    """
+
+    def __init__(self, limit=10, tracemalloc_action=None, tracemalloc_frames=1):
+        self.limit              = limit
+        self.tracemalloc_action = tracemalloc_action
+        self.tracemalloc_frames = tracemalloc_frames
+
+    def perform(self):
+        """ Carries out the request in the process receiving it.
+        """
+        if self.tracemalloc_action == 'start':
+            start_tracemalloc(self.tracemalloc_frames)
+        elif self.tracemalloc_action == 'stop':
+            stop_tracemalloc()
+        return process_stats(self.limit)
+
+
+def start_tracemalloc(frames=1):
+    """ Starts tracing memory allocations, keeping frames frames of each
+        allocation's traceback. Tracing slows the process down and uses memory
+        of its own, so stop it once you're done.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def stop_tracemalloc():
+    """ Stops tracing memory allocations, freeing the traces recorded.
+    """
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def take_snapshot():
+    """ A snapshot of the memory allocated since tracing started (or None if
+        tracemalloc isn't tracing).
+    """
+    if not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.take_snapshot().filter_traces(_IGNORED_ALLOCATIONS)
+
+
+def top_allocations(snapshot, limit=10, key_type='lineno'):
+    """ The places holding the most memory in the snapshot, largest first.
+    """
+    return [{'location': _format_traceback(stat.traceback), 'size': stat.size, 'count': stat.count}
+            for stat in snapshot.statistics(key_type)[:limit]]
+
+
+def compare_snapshots(old_snapshot, new_snapshot, limit=10, key_type='lineno'):
+    """ The places whose memory grew (or shrank) the most between two snapshots.
+    """
+    return [{'location': _format_traceback(stat.traceback), 'size': stat.size, 'size_diff': stat.size_diff,
+             'count': stat.count, 'count_diff': stat.count_diff}
+            for stat in new_snapshot.compare_to(old_snapshot, key_type)[:limit]]
+
+
+def process_stats(limit=10):
+    """ The memory statistics of this process. If tracemalloc is tracing the
+        top allocation sites are included.
+    """
+    stats = {'pid': os.getpid(),
+             'rss_bytes': _current_rss(),
+             'peak_rss_bytes': _peak_rss(),
+             'thread_count': threading.active_count(),
+             'gc_counts': gc.get_count(),
+             'gc_objects': len(gc.get_objects()),
+             'tracemalloc': {'tracing': tracemalloc.is_tracing()}}
+
+    if tracemalloc.is_tracing():
+        (current, peak) = tracemalloc.get_traced_memory()
+        stats['tracemalloc'].update({'current_bytes': current, 'peak_bytes': peak,
+                                     'frames': tracemalloc.get_traceback_limit(),
+                                     'top': top_allocations(take_snapshot(), limit)})
+    return stats
+
+
+def thread_stacks():
+    """ Every thread in this process (including the HTTP server's request
+        threads) with what it's currently doing.
+    """
+    frames = sys._current_frames()
+    threads = list()
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        threads.append({'name': thread.name, 'ident': thread.ident, 'daemon': thread.daemon,
+                        'stack': traceback.format_stack(frame) if frame else []})
+    return threads
+
+
+def _format_traceback(allocation_traceback):
+    return [str(frame.filename) + ':' + str(frame.lineno) for frame in allocation_traceback]
+
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS but kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
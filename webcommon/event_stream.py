@@ -0,0 +1,152 @@
+import queue
+import threading
+import logging
+
+from webcommon.base_webservice import BaseWebService
+
+
+class EventStreamSubscriber(object):
+    """ A single client connected to an EventStream. Events are buffered here
+        until the client's connection has written them out. The buffer is capped
+        so that a slow client is dropped rather than growing without limit.
+    """
+
+    def __init__(self, max_buffered_events):
+        self.dropped = False
+        self.closed  = False
+
+        self.__buffer = queue.Queue(maxsize=max_buffered_events)
+
+    def offer(self, encoded_event):
+        """ Buffers an already encoded event for this subscriber. Returns False
+            if the buffer is full, in which case the subscriber is marked as
+            dropped and will stop receiving events.
+        """
+        if self.dropped or self.closed:
+            return False
+        try:
+            self.__buffer.put_nowait(encoded_event)
+        except queue.Full:
+            self.dropped = True
+            return False
+        return True
+
+    def close(self):
+        """ Tells the subscriber there will be no more events.
+        """
+        self.closed = True
+        try:
+            self.__buffer.put_nowait(None)
+        except queue.Full:
+            # The connection will notice the closed flag at its next heartbeat.
+            pass
+
+    def next_event(self, timeout):
+        """ Blocks until the next event is available. Returns None if nothing
+            arrived within the timeout (or the subscriber was closed).
+        """
+        try:
+            return self.__buffer.get(block=True, timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventStream(object):
+    """ Fans out events to any number of clients connected with a long-lived
+        'text/event-stream' (Server-Sent Events) connection. Each event is encoded
+        once no matter how many clients are subscribed.
+    """
+
+    HEARTBEAT = b': heartbeat\n\n'
+
+    def __init__(self, max_buffered_events=64, heartbeat_interval=15.0):
+        self.max_buffered_events = max_buffered_events
+        self.heartbeat_interval  = heartbeat_interval
+
+        self.__subscribers      = set()
+        self.__subscribers_lock = threading.Lock()
+        self.__closed           = False
+
+    @staticmethod
+    def encode_event(data, event=None, event_id=None):
+        """ Encodes an event in the Server-Sent Events wire format.
+        """
+        lines = list()
+        if event:
+            lines.append('event: ' + str(event))
+        if event_id is not None:
+            lines.append('id: ' + str(event_id))
+        for data_line in str(data).split('\n'):
+            lines.append('data: ' + data_line)
+
+        return ('\n'.join(lines) + '\n\n').encode()
+
+    def subscriber_count(self):
+        with self.__subscribers_lock:
+            return len(self.__subscribers)
+
+    def subscribe(self):
+        """ Returns the response which streams the events to the client. Return
+            this from perform_request. The client is only subscribed once the
+            response starts being sent, so a response which never is (e.g. the
+            answer to a HEAD request) holds nothing.
+        """
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        return BaseWebService.StreamingServiceResponse(self.__stream_to_subscriber(),
+                                                       add_headers=headers,
+                                                       content_type='text/event-stream')
+
+    def unsubscribe(self, subscriber):
+        with self.__subscribers_lock:
+            self.__subscribers.discard(subscriber)
+
+    def publish(self, data, event=None, event_id=None):
+        """ Sends an event to every subscriber. Subscribers whose buffer is full
+            are dropped.
+        """
+        encoded_event = self.encode_event(data, event, event_id)
+
+        with self.__subscribers_lock:
+            subscribers = list(self.__subscribers)
+
+        for subscriber in subscribers:
+            if not subscriber.offer(encoded_event):
+                logging.info('Dropping slow event stream subscriber')
+                self.unsubscribe(subscriber)
+
+    def close(self):
+        """ Disconnects all subscribers and refuses any new ones.
+        """
+        with self.__subscribers_lock:
+            self.__closed = True
+            subscribers = list(self.__subscribers)
+            self.__subscribers.clear()
+
+        for subscriber in subscribers:
+            subscriber.close()
+
+    def __stream_to_subscriber(self):
+        """ Generator producing the body of a subscriber's response. A heartbeat
+            comment is sent whenever no event arrives within the heartbeat
+            interval so that dead connections are noticed.
+        """
+        subscriber = EventStreamSubscriber(self.max_buffered_events)
+        with self.__subscribers_lock:
+            if self.__closed:
+                return
+            self.__subscribers.add(subscriber)
+
+        try:
+            yield self.HEARTBEAT
+            while not subscriber.dropped and not subscriber.closed:
+                encoded_event = subscriber.next_event(self.heartbeat_interval)
+                if subscriber.dropped:
+                    break
+                if encoded_event is None:
+                    if subscriber.closed:
+                        break
+                    yield self.HEARTBEAT
+                else:
+                    yield encoded_event
+        finally:
+            self.unsubscribe(subscriber)
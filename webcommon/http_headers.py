@@ -0,0 +1,103 @@
+from http import HTTPStatus
+
+
+class HeaderParseError(Exception):
+    """ Raised when a client's header block is malformed or breaks one of the
+        configured limits. Holds the HTTP status the client should be sent.
+    """
+
+    def __init__(self, resp_code, message, violation='malformed_headers'):
+        super().__init__(message)
+        self.resp_code = resp_code
+        self.message   = message
+        self.violation = violation
+
+
+class HeaderMap(object):
+    """ A light replacement for the email.message.Message normally used to hold
+        request headers. Lookups are case-insensitive and get/get_all/items behave
+        the same way so existing code (e.g. check_authentication) is unaffected.
+    """
+    __slots__ = ('__items', '__first')
+
+    def __init__(self, items=None):
+        self.__items = list()
+        self.__first = dict()
+        if items:
+            for name, value in items:
+                self.add(name, value)
+
+    def add(self, name, value):
+        self.__items.append((name, value))
+        self.__first.setdefault(name.lower(), value)
+
+    def get(self, name, default=None):
+        return self.__first.get(name.lower(), default)
+
+    def get_all(self, name, default=None):
+        name = name.lower()
+        values = [value for (key, value) in self.__items if key.lower() == name]
+        return values if values else default
+
+    def items(self):
+        return list(self.__items)
+
+    def keys(self):
+        return [name for (name, value) in self.__items]
+
+    def values(self):
+        return [value for (name, value) in self.__items]
+
+    def __getitem__(self, name):
+        # Like email.message.Message, a missing header gives None rather than a KeyError
+        return self.__first.get(name.lower())
+
+    def __contains__(self, name):
+        return name.lower() in self.__first
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __str__(self):
+        return ''.join(name + ': ' + value + '\r\n' for (name, value) in self.__items) + '\r\n'
+
+
+def read_header_block(rfile, max_header_count=100, max_line_length=8192, max_header_bytes=65536):
+    """ Reads the header block of a request from rfile in a single pass, stopping
+        at the blank line which ends it. Raises HeaderParseError as soon as the
+        block is malformed or too large so the rest of it is never read.
+    """
+    headers     = HeaderMap()
+    total_bytes = 0
+
+    while True:
+        line = rfile.readline(max_line_length + 1)
+        if len(line) > max_line_length:
+            raise HeaderParseError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, 'Header line too long',
+                                   'headers_too_large')
+
+        total_bytes += len(line)
+        if total_bytes > max_header_bytes:
+            raise HeaderParseError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, 'Header block too large',
+                                   'headers_too_large')
+
+        if line in (b'\r\n', b'\n'):
+            return headers
+        if not line:
+            raise HeaderParseError(HTTPStatus.BAD_REQUEST, 'Header block ended early')
+        if line[0] in b' \t':
+            # Obsolete line folding is a well known request smuggling vector
+            raise HeaderParseError(HTTPStatus.BAD_REQUEST, 'Folded header lines are not supported')
+
+        name, separator, value = line.partition(b':')
+        if not separator or not name or name.rstrip() != name:
+            raise HeaderParseError(HTTPStatus.BAD_REQUEST, 'Malformed header line')
+
+        if len(headers) >= max_header_count:
+            raise HeaderParseError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, 'Too many headers',
+                                   'too_many_headers')
+
+        headers.add(name.decode('latin-1'), value.strip().decode('latin-1'))
@@ -0,0 +1,195 @@
+import pickle
+import logging
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # Shared memory needs Python 3.8 or later
+    shared_memory = None
+    resource_tracker = None
+
+
+class QueueSerialiser(object):
+    """ The default serialiser used between a BaseBackgroundWebService and its
+        BaseBackgroundProcess. Messages are handed to the multiprocessing queue
+        untouched, which pickles them and copies them through a pipe. Subclass
+        this to change how messages travel between the two processes.
+    """
+
+    def prepare(self):
+        """ Called in the WebService's process before the background process is
+            started.
+        """
+        pass
+
+    def dumps(self, message):
+        """ Converts a message into whatever should be put onto the queue.
+        """
+        return message
+
+    def loads(self, data):
+        """ Converts whatever was taken off the queue back into the message.
+        """
+        return data
+
+    def discard(self, data):
+        """ Called for data taken off the queue which will never be loaded (for
+            example a reply which arrived after its request timed out) so that
+            anything it holds can be released.
+        """
+        pass
+
+
+class SharedMemoryHandle(object):
+    """ The small handle put onto the queue in place of a large message. It names
+        the shared memory block holding the pickled message and its out-of-band
+        buffers.
+    """
+    __slots__ = ('name', 'sizes')
+
+    def __init__(self, name, sizes):
+        self.name  = name
+        self.sizes = sizes
+
+    def __getstate__(self):
+        return (self.name, self.sizes)
+
+    def __setstate__(self, state):
+        (self.name, self.sizes) = state
+
+
+class PickledMessage(object):
+    """ A message below the threshold, already pickled by the serialiser. It
+        goes through the queue as it is so the message isn't pickled twice.
+    """
+    __slots__ = ('data', 'buffers')
+
+    def __init__(self, data, buffers):
+        self.data    = data
+        self.buffers = buffers
+
+    def __getstate__(self):
+        return (self.data, self.buffers)
+
+    def __setstate__(self, state):
+        (self.data, self.buffers) = state
+
+
+class SharedMemorySerialiser(QueueSerialiser):
+    """ Pickles messages with protocol 5 so that large buffers (bytearrays, numpy
+        arrays etc.) are kept out-of-band rather than copied into the pickle.
+        Messages at or above the threshold are written into a shared memory block
+        and only a SharedMemoryHandle is sent through the queue. Smaller ones are
+        sent as the PickledMessage already produced while measuring them.
+
+        A block is created by the sending process and unlinked by the receiving
+        process as soon as it has loaded (or discarded) the message. If the loaded
+        message still refers to the block's memory (zero-copy buffers) the block is
+        kept mapped until the next load finds it is no longer used.
+    """
+
+    def __init__(self, threshold=1024 * 1024):
+        if shared_memory is None:
+            raise RuntimeError('SharedMemorySerialiser needs Python 3.8 or later')
+
+        self.threshold = threshold
+
+        self.__retained_blocks = list()
+
+    def __getstate__(self):
+        # Blocks retained by one process are never handed to another
+        return {'threshold': self.threshold}
+
+    def __setstate__(self, state):
+        self.threshold = state['threshold']
+        self.__retained_blocks = list()
+
+    def prepare(self):
+        # Make sure both processes share one resource tracker so a block created
+        # in one process and unlinked in the other is tracked correctly.
+        resource_tracker.ensure_running()
+
+    def dumps(self, message):
+        buffers = list()
+        data = pickle.dumps(message, protocol=5, buffer_callback=buffers.append)
+        raw_buffers = [buffer.raw() for buffer in buffers]
+
+        total_size = len(data) + sum(raw.nbytes for raw in raw_buffers)
+        if total_size < self.threshold:
+            # Small enough to go through the queue, the buffers are copied in-band
+            return PickledMessage(data, [raw.tobytes() for raw in raw_buffers])
+
+        block = shared_memory.SharedMemory(create=True, size=max(total_size, 1))
+        try:
+            sizes = list()
+            offset = 0
+            for chunk in [memoryview(data)] + raw_buffers:
+                block.buf[offset:offset + chunk.nbytes] = chunk.cast('B')
+                offset += chunk.nbytes
+                sizes.append(chunk.nbytes)
+        except BaseException:
+            block.close()
+            block.unlink()
+            raise
+
+        handle = SharedMemoryHandle(block.name, sizes)
+        block.close()
+        return handle
+
+    def loads(self, data):
+        if isinstance(data, PickledMessage):
+            return pickle.loads(data.data, buffers=data.buffers)
+        if not isinstance(data, SharedMemoryHandle):
+            return data
+
+        self.__release_retained_blocks()
+
+        block = shared_memory.SharedMemory(name=data.name)
+        # Unlink straight away, the memory itself lives on while it is mapped
+        block.unlink()
+
+        views = list()
+        offset = 0
+        for size in data.sizes:
+            views.append(block.buf[offset:offset + size])
+            offset += size
+
+        try:
+            message = pickle.loads(views[0], buffers=views[1:])
+        finally:
+            for view in views:
+                try:
+                    view.release()
+                except BufferError:
+                    pass
+
+        try:
+            block.close()
+        except BufferError:
+            # The message is still using the block's memory (zero-copy)
+            self.__retained_blocks.append(block)
+
+        return message
+
+    def discard(self, data):
+        if not isinstance(data, SharedMemoryHandle):
+            return
+
+        try:
+            block = shared_memory.SharedMemory(name=data.name)
+        except FileNotFoundError:
+            return
+        block.close()
+        block.unlink()
+
+    def __release_retained_blocks(self):
+        still_retained = list()
+        for block in self.__retained_blocks:
+            try:
+                block.close()
+            except BufferError:
+                still_retained.append(block)
+        if len(still_retained) != len(self.__retained_blocks):
+            logging.debug('Released ' + str(len(self.__retained_blocks) - len(still_retained)) +
+                          ' shared memory blocks')
+        self.__retained_blocks = still_retained
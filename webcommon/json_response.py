@@ -0,0 +1,130 @@
+import collections
+import json
+import threading
+
+from webcommon.base_webservice import BaseWebService, HTTPStatus
+
+try:
+    import orjson
+except ImportError:
+    # Optional, the json module is used when it isn't installed
+    orjson = None
+
+CONTENT_TYPE = 'application/json'
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def encode_json(data, default=None):
+    """ Encodes data as compact UTF-8 JSON bytes, with orjson if it's installed.
+        default(obj) is called for objects which can't otherwise be encoded and
+        should return something which can (e.g. default=str).
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers too big for orjson, the json module copes
+            pass
+    if default is None:
+        return _encoder.encode(data).encode('utf-8')
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=default).encode('utf-8')
+
+
+class _EncodedCache(object):
+    """ Remembers the encoded bytes (and ETag) of the most recently used objects
+        passed to JsonServiceResponse with memoize=True.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+        self.__entries = collections.OrderedDict()
+        self.__lock    = threading.Lock()
+
+    def get(self, data, default):
+        key = id(data)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            # The object itself is held so its id can't be reused by another
+            if entry is not None and entry[0] is data:
+                self.__entries.move_to_end(key)
+                return entry[1:]
+
+        payload = encode_json(data, default)
+        etag = BaseWebService.make_etag(payload)
+        with self.__lock:
+            self.__entries[key] = (data, payload, etag)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.capacity:
+                self.__entries.popitem(last=False)
+        return (payload, etag)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+
+# The memoized objects are shared by every web service
+encoded_cache = _EncodedCache(capacity=256)
+
+
+class JsonServiceResponse(BaseWebService.ServiceResponse):
+    """ A ServiceResponse whose payload is data encoded as JSON, ready to return
+        from perform_request.
+
+        Pass memoize=True when the same object is returned again and again (a
+        result which is replaced rather than changed, for example) to encode it
+        and compute its ETag only the first time. The object must never be
+        modified after it has been returned, as the bytes already encoded would
+        still be sent.
+    """
+    __slots__ = ()
+
+    def __init__(self, data, resp_code=HTTPStatus.OK, add_headers=None, etag=None, memoize=False,
+                 default=None):
+        if memoize:
+            (payload, memoized_etag) = encoded_cache.get(data, default)
+            if etag is None:
+                etag = memoized_etag
+        else:
+            payload = encode_json(data, default)
+
+        super().__init__(payload=payload, resp_code=resp_code, add_headers=add_headers,
+                         add_html_wrapper=False, content_type=CONTENT_TYPE, etag=etag)
+
+
+class StreamingJsonServiceResponse(BaseWebService.StreamingServiceResponse):
+    """ Streams the items of an iterable (e.g. a generator reading rows from a
+        database) to the client as a JSON array, encoding them as they're needed
+        rather than building the whole array in memory. Items are sent in chunks
+        of about chunk_size bytes.
+    """
+    __slots__ = ()
+
+    def __init__(self, items, resp_code=HTTPStatus.OK, add_headers=None, default=None, chunk_size=64 * 1024):
+        super().__init__(self.__encode_array(items, default, chunk_size), resp_code=resp_code,
+                         add_headers=add_headers, content_type=CONTENT_TYPE)
+
+    @staticmethod
+    def __encode_array(items, default, chunk_size):
+        items = iter(items)
+        try:
+            chunk = [b'[']
+            chunk_length = 1
+            separator = b''
+            for item in items:
+                encoded = encode_json(item, default)
+                chunk.append(separator)
+                chunk.append(encoded)
+                chunk_length += len(encoded) + 1
+                separator = b','
+                if chunk_length >= chunk_size:
+                    yield b''.join(chunk)
+                    chunk = list()
+                    chunk_length = 0
+            chunk.append(b']')
+            yield b''.join(chunk)
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
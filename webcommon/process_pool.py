@@ -0,0 +1,22 @@
+import logging
+
+# The web services created in this (worker) process, keyed by their class.
+_worker_web_services = dict()
+
+
+def perform_request_in_worker(web_service_class, request):
+    """ Runs inside a process pool worker. Each worker creates and starts its own
+        instance of the web service the first time it's asked to perform one of
+        its requests and reuses it from then on, so only the (detached) request
+        and the response cross between processes.
+    """
+    web_service = _worker_web_services.get(web_service_class)
+    if web_service is None:
+        logging.debug('Starting ' + web_service_class.__name__ + ' in process pool worker')
+        web_service = web_service_class()
+        # Other web services aren't running in the worker
+        web_service.initialise(list())
+        web_service.start()
+        _worker_web_services[web_service_class] = web_service
+
+    return web_service.perform_request(request)
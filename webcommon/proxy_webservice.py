@@ -0,0 +1,454 @@
+import http.client
+import itertools
+import logging
+import select
+import socket
+import threading
+import urllib.parse
+
+from http import HTTPStatus
+
+from webcommon.base_webservice import BaseWebService, ServiceUnavailableError
+from webcommon.http_headers import HeaderMap
+from webcommon.scheduler import TaskScheduler
+
+
+class UpstreamConnectionPool(object):
+    """ A thread-safe pool of keep-alive connections to a single upstream. Idle
+        connections are reused most recently released first, anything beyond
+        max_idle_connections is closed rather than kept.
+    """
+
+    def __init__(self, host, port, use_tls=False, max_idle_connections=8,
+                 connect_timeout=5.0, read_timeout=30.0):
+        self.host                 = host
+        self.port                 = port
+        self.use_tls              = use_tls
+        self.max_idle_connections = max_idle_connections
+        self.connect_timeout      = connect_timeout
+        self.read_timeout         = read_timeout
+
+        self.__idle_connections = list()
+        self.__lock             = threading.Lock()
+
+    def acquire(self):
+        """ Returns a connected HTTPConnection and whether it was reused from the
+            pool (a reused connection may still have been closed by the upstream
+            in a way that can't be seen until it is written to).
+        """
+        while True:
+            with self.__lock:
+                if not self.__idle_connections:
+                    break
+                connection = self.__idle_connections.pop()
+            if self.__is_usable(connection):
+                return (connection, True)
+            connection.close()
+
+        return (self.__connect(), False)
+
+    def release(self, connection):
+        """ Hands a connection whose response has been read in full back to the
+            pool.
+        """
+        if connection.sock is None:
+            return
+        with self.__lock:
+            if len(self.__idle_connections) < self.max_idle_connections:
+                self.__idle_connections.append(connection)
+                return
+        connection.close()
+
+    def discard(self, connection):
+        connection.close()
+
+    def idle_count(self):
+        with self.__lock:
+            return len(self.__idle_connections)
+
+    def close(self):
+        with self.__lock:
+            connections = self.__idle_connections
+            self.__idle_connections = list()
+        for connection in connections:
+            connection.close()
+
+    def __connect(self):
+        if self.use_tls:
+            connection = http.client.HTTPSConnection(self.host, self.port, timeout=self.connect_timeout)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+        connection.connect()
+        # Once connected it's the time between reads that matters
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+    @staticmethod
+    def __is_usable(connection):
+        """ An idle keep-alive connection has nothing to read. If its socket is
+            readable the upstream has closed it (or sent something unexpected).
+        """
+        if connection.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+
+class Upstream(object):
+    """ One of the backends a BaseProxyWebService forwards requests to, along
+        with its connection pool and health.
+    """
+
+    def __init__(self, url, max_idle_connections=8, connect_timeout=5.0, read_timeout=30.0):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise ValueError('Upstream url must be http(s)://host[:port][/path]: ' + url)
+
+        self.url         = url
+        self.base_path   = parsed.path.rstrip('/')
+        self.host_header = parsed.netloc
+        self.pool        = UpstreamConnectionPool(parsed.hostname, parsed.port,
+                                                  use_tls=parsed.scheme == 'https',
+                                                  max_idle_connections=max_idle_connections,
+                                                  connect_timeout=connect_timeout,
+                                                  read_timeout=read_timeout)
+        self.healthy     = True
+
+        self.__failures = 0
+        self.__lock     = threading.Lock()
+
+    def record_success(self):
+        """ Returns True if this brings an ejected upstream back into use.
+        """
+        with self.__lock:
+            self.__failures = 0
+            was_ejected  = not self.healthy
+            self.healthy = True
+            return was_ejected
+
+    def record_failure(self, failure_threshold):
+        """ Returns True if this failure ejects the upstream.
+        """
+        with self.__lock:
+            self.__failures += 1
+            if self.healthy and self.__failures >= failure_threshold:
+                self.healthy = False
+                return True
+            return False
+
+
+class BaseProxyWebService(BaseWebService):
+    """ The BaseProxyWebService forwards the requests routed to it on to one of
+        a number of upstream HTTP servers (taken in turn) and streams the
+        response back to the client. Connections to each upstream are kept alive
+        and pooled. Upstreams which fail repeatedly are ejected until a health
+        check finds them working again.
+
+        Subclasses can override get_upstream_target to change the path sent to
+        the upstream or perform_request to decide which requests are forwarded.
+    """
+
+    # Headers which only apply to a single connection and so are never forwarded
+    HOP_BY_HOP_HEADERS = frozenset(('connection', 'keep-alive', 'proxy-authenticate',
+                                    'proxy-authorization', 'proxy-connection', 'te', 'trailer',
+                                    'trailers', 'transfer-encoding', 'upgrade'))
+
+    # Requests which can safely be sent again if the upstream may have seen them
+    IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'))
+
+    # Upstream response headers left out as the handler sends its own
+    LOCAL_RESPONSE_HEADERS = frozenset(('content-length', 'content-type', 'server', 'date'))
+
+    CHUNK_SIZE = 64 * 1024
+
+    # HEAD requests are forwarded as they are, the upstream leaves out the body
+    handles_head_requests = True
+
+    # Configuration item keys used to drill down into the WebService config.
+    # A list of upstream urls (e.g. 'http://10.0.0.5:8080/api'). Any entry can
+    # instead be a dict with the url under CONF_ITM_UPSTREAM_URL along with its
+    # own timeouts and pool size.
+    CONF_ITM_UPSTREAMS              = 'upstreams'
+    CONF_ITM_UPSTREAM_URL           = 'url'
+    CONF_ITM_CONNECT_TIMEOUT        = 'connect_timeout'
+    CONF_ITM_READ_TIMEOUT           = 'read_timeout'
+    CONF_ITM_MAX_IDLE_CONNECTIONS   = 'max_idle_connections'
+    # Health checking and ejection (an interval of 0 disables both)
+    CONF_ITM_HEALTH_CHECK_PATH      = 'health_check_path'
+    CONF_ITM_HEALTH_CHECK_INTERVAL  = 'health_check_interval'
+    CONF_ITM_HEALTH_CHECK_THRESHOLD = 'health_check_failure_threshold'
+
+    def __init__(self, web_service_config):
+        super().__init__(web_service_config)
+
+        self.health_check_path      = web_service_config.get(self.CONF_ITM_HEALTH_CHECK_PATH, '/')
+        self.health_check_interval  = float(web_service_config.get(self.CONF_ITM_HEALTH_CHECK_INTERVAL, 10))
+        self.health_check_threshold = int(web_service_config.get(self.CONF_ITM_HEALTH_CHECK_THRESHOLD, 3))
+
+        self.upstreams = [self.__create_upstream(upstream_config, web_service_config)
+                          for upstream_config in web_service_config.get(self.CONF_ITM_UPSTREAMS, [])]
+        if not self.upstreams:
+            logging.warning(self.service_name + ' has no upstreams configured')
+
+        self.__next_upstream = itertools.count()
+        self.__scheduler     = TaskScheduler()
+        self.__stopping      = threading.Event()
+        self.__health_thread = None
+
+    def start(self):
+        if self.health_check_interval > 0 and self.upstreams:
+            self.__stopping.clear()
+            self.__scheduler.schedule(self.health_check_interval, self.check_upstream_health,
+                                      fixed_rate=True)
+            self.__health_thread = threading.Thread(target=self.__run_health_checks, daemon=True)
+            self.__health_thread.start()
+
+    def stop(self):
+        self.__stopping.set()
+        self.__scheduler.wake()
+        if self.__health_thread:
+            self.__health_thread.join(2)
+            self.__health_thread = None
+        for upstream in self.upstreams:
+            upstream.pool.close()
+
+    def perform_request(self, request):
+        return self.forward_request(request)
+
+    def get_upstream_target(self, request, upstream):
+        """ Returns the request target (path and query string) to send to the
+            upstream. By default the client's target is appended to the path of
+            the upstream's url.
+        """
+        return upstream.base_path + request.target
+
+    def forward_request(self, request):
+        """ Forwards the request to the next healthy upstream and returns the
+            upstream's response, streamed. Any request is tried on the next
+            upstream if one can't be connected to (refused or timed out), as
+            nothing has been sent yet. Once sent, only idempotent requests
+            without a body are retried.
+        """
+        has_body = self.__request_has_body(request)
+        retry_after_send = not has_body and request.method in self.IDEMPOTENT_METHODS
+
+        for attempt in range(max(1, len(self.upstreams))):
+            upstream = self.__choose_upstream()
+            try:
+                connection, reused = upstream.pool.acquire()
+            except OSError as err:
+                self.__record_upstream_failure(upstream)
+                logging.warning('Cannot connect to upstream ' + upstream.url + ': ' + repr(err))
+                continue
+
+            try:
+                return self.__exchange(upstream, connection, reused, request, has_body, retry_after_send)
+            except socket.timeout:
+                self.__record_upstream_failure(upstream)
+                logging.warning('Timed out waiting for upstream ' + upstream.url)
+                return BaseWebService.ServiceResponse(resp_code=HTTPStatus.GATEWAY_TIMEOUT)
+            except (OSError, http.client.HTTPException) as err:
+                self.__record_upstream_failure(upstream)
+                logging.warning('Upstream ' + upstream.url + ' failed: ' + repr(err))
+                if not retry_after_send:
+                    break
+
+        return BaseWebService.ServiceResponse(resp_code=HTTPStatus.BAD_GATEWAY)
+
+    def check_upstream_health(self):
+        """ Requests the health check path from every upstream, ejecting those
+            which keep failing and bringing back those which have recovered.
+        """
+        for upstream in self.upstreams:
+            # A fresh connection each time so a check never waits behind requests
+            connection_class = http.client.HTTPSConnection if upstream.pool.use_tls else http.client.HTTPConnection
+            connection = connection_class(upstream.pool.host, upstream.pool.port,
+                                          timeout=upstream.pool.connect_timeout)
+            try:
+                connection.request('GET', upstream.base_path + self.health_check_path,
+                                   headers={'Host': upstream.host_header})
+                healthy = connection.getresponse().status < 500
+            except (OSError, http.client.HTTPException):
+                healthy = False
+            finally:
+                connection.close()
+
+            if healthy:
+                if upstream.record_success():
+                    logging.info('Upstream ' + upstream.url + ' is healthy again')
+            else:
+                self.__record_upstream_failure(upstream)
+
+    def __exchange(self, upstream, connection, reused, request, has_body, retry_after_send):
+        """ Sends the request to the upstream over the connection and returns the
+            response to send back to the client.
+        """
+        try:
+            target  = self.get_upstream_target(request, upstream)
+            headers = self.__build_upstream_headers(request, upstream)
+            try:
+                response = self.__send(connection, request, target, headers, has_body)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused or not retry_after_send:
+                    raise
+                # The upstream closed the idle connection just as it was reused
+                connection.close()
+                connection, reused = upstream.pool.acquire()
+                response = self.__send(connection, request, target, headers, has_body)
+        except BaseException:
+            upstream.pool.discard(connection)
+            raise
+
+        if upstream.record_success():
+            logging.info('Upstream ' + upstream.url + ' is healthy again')
+
+        return self.__build_response(upstream, connection, request, response)
+
+    def __send(self, connection, request, target, headers, has_body):
+        connection.putrequest(request.method, target, skip_host=True, skip_accept_encoding=True)
+        for header_key, header_value in headers:
+            connection.putheader(header_key, header_value)
+        connection.endheaders()
+
+        if has_body:
+            for chunk in request.iter_body(self.CHUNK_SIZE):
+                connection.send(chunk)
+
+        return connection.getresponse()
+
+    def __build_upstream_headers(self, request, upstream):
+        headers = self.__end_to_end_headers(request.headers.items() if request.headers else [])
+
+        original_host = request.headers.get('Host') if request.headers else None
+        forwarded_for = request.headers.get('X-Forwarded-For') if request.headers else None
+        client_address = request.client_address
+
+        headers = [(key, value) for (key, value) in headers
+                   if key.lower() not in ('host', 'x-forwarded-for', 'x-forwarded-host',
+                                          'x-forwarded-proto')]
+        headers.append(('Host', upstream.host_header))
+        if client_address:
+            headers.append(('X-Forwarded-For',
+                            forwarded_for + ', ' + client_address if forwarded_for else client_address))
+        if original_host:
+            headers.append(('X-Forwarded-Host', original_host))
+        headers.append(('X-Forwarded-Proto', 'http'))
+        return headers
+
+    def __build_response(self, upstream, connection, request, response):
+        try:
+            resp_code = HTTPStatus(response.status)
+        except ValueError:
+            logging.warning('Upstream ' + upstream.url + ' sent unknown status ' + str(response.status))
+            upstream.pool.discard(connection)
+            return BaseWebService.ServiceResponse(resp_code=HTTPStatus.BAD_GATEWAY)
+
+        add_headers = HeaderMap()
+        for header_key, header_value in self.__end_to_end_headers(response.getheaders()):
+            if header_key.lower() not in self.LOCAL_RESPONSE_HEADERS:
+                add_headers.add(header_key, header_value)
+
+        content_length = response.getheader('Content-Length')
+        content_length = int(content_length) if content_length and content_length.isdigit() else None
+
+        if resp_code in BaseWebService.ServiceResponse.BODYLESS_RESP_CODES or request.method == 'HEAD':
+            response.read()
+            self.__finish_response(upstream, connection, response)
+            # No body, but the upstream's description of the one a GET would get
+            return BaseWebService.StreamingServiceResponse(
+                (), resp_code=resp_code, add_headers=add_headers,
+                content_type=response.getheader('Content-Type'),
+                content_length=content_length if resp_code != HTTPStatus.NO_CONTENT else None)
+
+        return BaseWebService.StreamingServiceResponse(
+            self.__relay_body(upstream, connection, response),
+            resp_code=resp_code,
+            add_headers=add_headers,
+            content_type=response.getheader('Content-Type', 'application/octet-stream'),
+            content_length=content_length)
+
+    def __relay_body(self, upstream, connection, response):
+        """ Generator passing the upstream's response body on as it arrives. The
+            connection goes back to the pool only once the body has been read in
+            full.
+        """
+        completed = False
+        try:
+            while True:
+                chunk = response.read1(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            completed = True
+        except (OSError, http.client.HTTPException) as err:
+            logging.warning('Upstream ' + upstream.url + ' failed mid-response: ' + repr(err))
+        finally:
+            if completed:
+                self.__finish_response(upstream, connection, response)
+            else:
+                upstream.pool.discard(connection)
+
+    @staticmethod
+    def __finish_response(upstream, connection, response):
+        # The connection can't send another request until the response is closed
+        # (read1 doesn't close it on reaching the end of a Content-Length body)
+        response.close()
+        if response.will_close:
+            upstream.pool.discard(connection)
+        else:
+            upstream.pool.release(connection)
+
+    def __end_to_end_headers(self, headers):
+        """ Drops the hop-by-hop headers, including any named by the Connection
+            header.
+        """
+        headers = list(headers)
+        hop_by_hop = set(self.HOP_BY_HOP_HEADERS)
+        for header_key, header_value in headers:
+            if header_key.lower() == 'connection':
+                hop_by_hop.update(token.strip().lower() for token in header_value.split(','))
+        return [(key, value) for (key, value) in headers if key.lower() not in hop_by_hop]
+
+    def __request_has_body(self, request):
+        if request.method in request.METHODS_WITHOUT_PAYLOAD or not request.headers:
+            return False
+        content_length = request.headers.get('Content-Length')
+        return bool(content_length) and content_length.strip() != '0'
+
+    def __choose_upstream(self):
+        """ Round-robin over the healthy upstreams.
+        """
+        healthy_upstreams = [upstream for upstream in self.upstreams if upstream.healthy]
+        if not healthy_upstreams:
+            raise ServiceUnavailableError('No healthy upstreams for ' + self.service_name,
+                                          retry_after=self.health_check_interval or None)
+        return healthy_upstreams[next(self.__next_upstream) % len(healthy_upstreams)]
+
+    def __record_upstream_failure(self, upstream):
+        # Without health checks nothing would bring an ejected upstream back
+        if self.health_check_interval <= 0:
+            return
+        if upstream.record_failure(self.health_check_threshold):
+            logging.warning('Ejecting unhealthy upstream ' + upstream.url)
+
+    def __create_upstream(self, upstream_config, web_service_config):
+        if not isinstance(upstream_config, dict):
+            upstream_config = {self.CONF_ITM_UPSTREAM_URL: upstream_config}
+
+        def setting(key, default):
+            return upstream_config.get(key, web_service_config.get(key, default))
+
+        return Upstream(upstream_config[self.CONF_ITM_UPSTREAM_URL],
+                        max_idle_connections=int(setting(self.CONF_ITM_MAX_IDLE_CONNECTIONS, 8)),
+                        connect_timeout=float(setting(self.CONF_ITM_CONNECT_TIMEOUT, 5)),
+                        read_timeout=float(setting(self.CONF_ITM_READ_TIMEOUT, 30)))
+
+    def __run_health_checks(self):
+        while not self.__stopping.is_set():
+            next_due = self.__scheduler.run_due_tasks()
+            if self.__stopping.is_set():
+                break
+            self.__scheduler.wait(next_due)
@@ -0,0 +1,170 @@
+import json
+import urllib.parse
+import http.cookies
+
+from webcommon.http_headers import HeaderMap
+
+# Marks lazily parsed attributes which haven't been worked out yet.
+_UNPARSED = object()
+# Marks a body which has been streamed (so can't be read again).
+_STREAMED = object()
+
+
+class Request(object):
+    """ Holds everything known about a client's request. The url path is split
+        from the query string as soon as the request is created (so routing only
+        ever sees the path) but the query parameters, cookies, client address
+        and body are only parsed the first time they are asked for.
+    """
+    __slots__ = ('handler', 'method', 'path', 'query_string', 'headers',
+                 '__query', '__cookies', '__client_address', '__body', '__payload')
+
+    # Requests made with these methods carry no payload
+    METHODS_WITHOUT_PAYLOAD = ('GET', 'DELETE', 'HEAD', 'OPTIONS')
+
+    def __init__(self, method, target, headers, handler=None, body=None, client_address=None,
+                 payload=_UNPARSED):
+        """ Creates a Request for the given method and request target (the url
+            path including any query string). The body is read from the handler
+            on demand unless it is given here.
+        """
+        path, _, query_string = target.partition('?')
+        path = path.partition('#')[0]
+
+        self.handler      = handler
+        self.method       = method
+        self.path         = path if path else '/'
+        self.query_string = query_string.partition('#')[0]
+        self.headers      = headers
+
+        self.__query          = _UNPARSED
+        self.__cookies        = _UNPARSED
+        self.__client_address = client_address if client_address is not None else _UNPARSED
+        self.__body           = body if body is not None else _UNPARSED
+        self.__payload        = payload
+
+    def __reduce__(self):
+        # Only a detached request (see detach) can be pickled, there's no
+        # connection to read from on the other side.
+        if self.handler is not None:
+            raise TypeError('Detach the Request before pickling it')
+        return (self.__class__, (self.method, self.target, self.headers, None, self.body,
+                                 self.client_address))
+
+    def detach(self):
+        """ Returns a copy of this request which no longer needs the connection,
+            with the body read in full. A detached request can be pickled, for
+            example to be performed in another process.
+        """
+        headers = self.headers
+        if headers is not None and not isinstance(headers, HeaderMap):
+            headers = HeaderMap(headers.items())
+        return Request(self.method, self.target, headers, body=self.body,
+                       client_address=self.client_address)
+
+    @property
+    def target(self):
+        """ The url path with the query string put back on.
+        """
+        if self.query_string:
+            return self.path + '?' + self.query_string
+        return self.path
+
+    @property
+    def query(self):
+        """ The query parameters as a dictionary of lists (a parameter may be
+            given more than once).
+        """
+        if self.__query is _UNPARSED:
+            self.__query = urllib.parse.parse_qs(self.query_string, keep_blank_values=True)
+        return self.__query
+
+    def get_query_param(self, name, default=None):
+        """ Returns the first value given for a query parameter.
+        """
+        values = self.query.get(name)
+        return values[0] if values else default
+
+    @property
+    def cookies(self):
+        """ The cookies sent by the client as a dictionary of name to value.
+        """
+        if self.__cookies is _UNPARSED:
+            cookies = dict()
+            cookie_header = self.headers.get('Cookie') if self.headers else None
+            if cookie_header:
+                parsed = http.cookies.SimpleCookie()
+                try:
+                    parsed.load(cookie_header)
+                except http.cookies.CookieError:
+                    pass
+                for name, morsel in parsed.items():
+                    cookies[name] = morsel.value
+            self.__cookies = cookies
+        return self.__cookies
+
+    @property
+    def client_address(self):
+        """ The IP address of the client (or None when unknown).
+        """
+        if self.__client_address is _UNPARSED:
+            client_address = getattr(self.handler, 'client_address', None)
+            if isinstance(client_address, tuple):
+                self.__client_address = client_address[0]
+            else:
+                self.__client_address = client_address if client_address else None
+        return self.__client_address
+
+    @property
+    def body(self):
+        """ The raw bytes of the request body, read from the connection the first
+            time they are asked for.
+        """
+        if self.__body is _STREAMED:
+            raise RuntimeError('The request body has already been streamed')
+        if self.__body is _UNPARSED:
+            if self.handler is not None and hasattr(self.handler, 'read_body'):
+                self.__body = self.handler.read_body()
+            else:
+                self.__body = b''
+        return self.__body
+
+    def iter_body(self, chunk_size=65536):
+        """ Yields the request body in chunks as it arrives rather than reading it
+            all into memory first (e.g. to forward it elsewhere). Once streamed the
+            body can't be read again.
+        """
+        if self.__body is _UNPARSED and hasattr(self.handler, 'iter_body'):
+            self.__body = _STREAMED
+            yield from self.handler.iter_body(chunk_size)
+            return
+
+        body = self.body
+        for offset in range(0, len(body), chunk_size):
+            yield body[offset:offset + chunk_size]
+
+    @property
+    def payload_type(self):
+        return self.__get_payload()[0]
+
+    @property
+    def payload_content(self):
+        return self.__get_payload()[1]
+
+    @staticmethod
+    def decode_payload(content_type, raw_message_body):
+        """ Decodes a request body according to its content type - JSON is loaded
+            and anything else is treated as url encoded text.
+        """
+        if content_type == 'application/json':
+            return json.loads(raw_message_body.decode())
+        return urllib.parse.unquote_plus(raw_message_body.decode())
+
+    def __get_payload(self):
+        if self.__payload is _UNPARSED:
+            if self.method in self.METHODS_WITHOUT_PAYLOAD:
+                self.__payload = (None, None)
+            else:
+                content_type = self.headers.get('content-type', '') if self.headers else ''
+                self.__payload = (content_type, self.decode_payload(content_type, self.body))
+        return self.__payload
@@ -0,0 +1,105 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class ScheduledTask(object):
+    """ A task registered with a TaskScheduler. Keep hold of it if you need to
+        cancel the task later.
+    """
+
+    def __init__(self, interval, task, args, fixed_rate):
+        self.interval   = interval
+        self.task       = task
+        self.args       = args
+        self.fixed_rate = fixed_rate
+        self.cancelled  = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TaskScheduler(object):
+    """ Runs tasks at regular intervals using a heap ordered by the time each
+        task is next due, so the thread running the tasks can sleep until exactly
+        then rather than polling.
+
+        Interval tasks wait the full interval after each run finishes, fixed-rate
+        tasks are run every interval measured from when they were first due (runs
+        missed because a task overran are skipped rather than bunched up).
+    """
+
+    def __init__(self):
+        self.__heap      = list()
+        self.__sequence  = itertools.count()
+        self.__condition = threading.Condition()
+        self.__woken     = False
+
+    def schedule(self, interval, task, args=(), fixed_rate=False, initial_delay=None):
+        """ Registers a task to be called with args every interval seconds. The
+            first call is after initial_delay seconds (one interval if not given).
+        """
+        scheduled_task = ScheduledTask(interval, task, args, fixed_rate)
+        first_run = time.monotonic() + (interval if initial_delay is None else initial_delay)
+
+        with self.__condition:
+            heapq.heappush(self.__heap, (first_run, next(self.__sequence), scheduled_task))
+            # The new task may be due before whatever the runner is waiting for
+            self.__woken = True
+            self.__condition.notify_all()
+
+        return scheduled_task
+
+    def run_due_tasks(self):
+        """ Runs every task which is due and returns the number of seconds until
+            the next one is (or None if there are no tasks).
+        """
+        while True:
+            with self.__condition:
+                if not self.__heap:
+                    return None
+                (due, sequence, scheduled_task) = self.__heap[0]
+                if scheduled_task.cancelled:
+                    heapq.heappop(self.__heap)
+                    continue
+                now = time.monotonic()
+                if due > now:
+                    return due - now
+                heapq.heappop(self.__heap)
+
+            try:
+                scheduled_task.task(*scheduled_task.args)
+            except Exception:
+                logging.exception('Scheduled task failed')
+
+            if scheduled_task.cancelled:
+                continue
+
+            if scheduled_task.fixed_rate:
+                next_due = due + scheduled_task.interval
+                now = time.monotonic()
+                if next_due <= now:
+                    # Skip the runs missed while the task overran
+                    missed = int((now - next_due) // scheduled_task.interval) + 1
+                    next_due += missed * scheduled_task.interval
+            else:
+                next_due = time.monotonic() + scheduled_task.interval
+
+            with self.__condition:
+                heapq.heappush(self.__heap, (next_due, next(self.__sequence), scheduled_task))
+
+    def wait(self, timeout=None):
+        """ Sleeps until the timeout passes, a new task is scheduled or wake is
+            called.
+        """
+        with self.__condition:
+            if not self.__woken:
+                self.__condition.wait(timeout)
+            self.__woken = False
+
+    def wake(self):
+        with self.__condition:
+            self.__woken = True
+            self.__condition.notify_all()
@@ -0,0 +1,88 @@
+import logging
+import threading
+
+from webcommon.http_headers import HeaderMap
+from webcommon.request import Request
+
+
+class Subscription(object):
+    """ Returned by ServiceBus.subscribe. Cancel it to stop receiving messages.
+    """
+
+    def __init__(self, service_bus, topic, callback):
+        self.topic    = topic
+        self.callback = callback
+
+        self.__service_bus = service_bus
+
+    def cancel(self):
+        self.__service_bus.unsubscribe(self)
+
+
+class ServiceBus(object):
+    """ Lets web services in the same WSBlite process talk to each other without
+        going through HTTP. call performs a request on whichever web service owns
+        the url (with the usual routing and authentication) directly on the
+        calling thread, and publish/subscribe passes messages between web
+        services that don't need to know about each other. Nothing is copied or
+        serialised on the way - the objects passed are the objects received.
+
+        The controller creates the bus and sets it on every web service as
+        self.service_bus before they are initialised.
+    """
+
+    def __init__(self, controller):
+        self.__controller         = controller
+        self.__subscriptions      = dict()
+        self.__subscriptions_lock = threading.Lock()
+
+    def call(self, method, target, headers=None, body=None, payload_content=None,
+             payload_type='application/python'):
+        """ Performs a request on the web service owning the url and returns its
+            ServiceResponse (or None if it gave none). The target is the url path,
+            optionally with a query string. Pass headers (a dictionary) for
+            anything the web service checks, such as 'Authorization'. Either give
+            the raw body as bytes or hand any Python object straight to the web
+            service as the request's payload_content.
+        """
+        header_map = HeaderMap(headers.items() if headers else None)
+        if payload_content is not None:
+            request = Request(method, target, header_map, body=body,
+                              payload=(payload_type, payload_content))
+        else:
+            request = Request(method, target, header_map, body=body if body is not None else b'')
+
+        return self.__controller.perform_request(request)
+
+    def subscribe(self, topic, callback):
+        """ Calls callback(topic, message) for every message published to the
+            topic from now on. Returns a Subscription which can be cancelled.
+        """
+        subscription = Subscription(self, topic, callback)
+        with self.__subscriptions_lock:
+            # Copy on write so publish never needs the lock
+            subscribers = self.__subscriptions.get(topic, ())
+            self.__subscriptions[topic] = subscribers + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.__subscriptions_lock:
+            subscribers = self.__subscriptions.get(subscription.topic, ())
+            remaining = tuple(subscriber for subscriber in subscribers if subscriber is not subscription)
+            if remaining:
+                self.__subscriptions[subscription.topic] = remaining
+            else:
+                self.__subscriptions.pop(subscription.topic, None)
+
+    def publish(self, topic, message):
+        """ Passes the message to every subscriber of the topic, on the calling
+            thread, and returns how many there were. A subscriber raising an
+            exception doesn't stop the others receiving the message.
+        """
+        subscribers = self.__subscriptions.get(topic, ())
+        for subscription in subscribers:
+            try:
+                subscription.callback(topic, message)
+            except Exception:
+                logging.exception('Subscriber to ' + str(topic) + ' failed')
+        return len(subscribers)
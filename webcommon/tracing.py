@@ -0,0 +1,260 @@
+import collections
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+
+class Span(object):
+    """ A timed phase of a request. Spans are created through the Tracer and
+        form a tree under the root span started for each sampled request.
+    """
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start', 'end', 'attributes',
+                 '__tracer', '__trace_spans', '__previous')
+
+    def __init__(self, tracer, name, trace_id, parent_id, trace_spans, start=None):
+        self.name       = name
+        self.trace_id   = trace_id
+        self.span_id    = '%016x' % random.getrandbits(64)
+        self.parent_id  = parent_id
+        self.start      = start if start is not None else time.time()
+        self.end        = None
+        self.attributes = dict()
+
+        self.__tracer      = tracer
+        # Every span in the trace (shared with the other spans of the trace)
+        self.__trace_spans = trace_spans
+        self.__previous    = None
+
+    @property
+    def traceparent(self):
+        """ This span as a W3C traceparent header value.
+        """
+        return '00-%s-%s-01' % (self.trace_id, self.span_id)
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+
+    def child(self, name, start=None):
+        """ Starts a span below this one (without making it the current span).
+        """
+        span = Span(self.__tracer, name, self.trace_id, self.span_id, self.__trace_spans, start)
+        self.__trace_spans.append(span)
+        return span
+
+    def finish(self, end=None):
+        self.end = end if end is not None else time.time()
+        if self is self.__trace_spans[0]:
+            # The root span, so the whole trace is complete
+            self.__tracer.export(list(self.__trace_spans))
+
+    def to_dict(self):
+        return {'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id,
+                'parent_id': self.parent_id, 'start': self.start,
+                'duration_ms': round((self.end - self.start) * 1000, 3) if self.end else None,
+                'attributes': self.attributes}
+
+    def __enter__(self):
+        self.__previous = self.__tracer.swap_current_span(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.__tracer.swap_current_span(self.__previous)
+        self.finish()
+        return False
+
+
+class _NoopSpan(object):
+    """ Stands in for a Span when the request isn't being traced, so that
+        tracing costs next to nothing when it's disabled.
+    """
+    __slots__ = ()
+
+    traceparent = None
+
+    def set_attribute(self, name, value):
+        pass
+
+    def child(self, name, start=None):
+        return self
+
+    def finish(self, end=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def parse_traceparent(traceparent):
+    """ Returns the (trace id, parent span id, sampled) given by a W3C traceparent
+        header value, or None if it isn't valid.
+    """
+    if not traceparent:
+        return None
+    parts = traceparent.strip().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or parts[0] == 'ff':
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+        flags = int(parts[3][:2], 16)
+    except ValueError:
+        return None
+    if parts[1] == '0' * 32 or parts[2] == '0' * 16:
+        return None
+    return (parts[1], parts[2], bool(flags & 0x01))
+
+
+class Tracer(object):
+    """ Decides which requests are traced (a sample_rate of 0.1 traces one in
+        ten, requests arriving with a sampled traceparent are always traced) and
+        hands each finished trace to the exporters. The span being recorded on
+        each thread is tracked so the phases of a request can add their own
+        spans without being passed it.
+    """
+
+    def __init__(self, sample_rate=0.0, exporters=None):
+        self.sample_rate = sample_rate
+        self.exporters   = list(exporters) if exporters else list()
+
+        self.__local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 and bool(self.exporters)
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def remove_exporter(self, exporter):
+        if exporter in self.exporters:
+            self.exporters.remove(exporter)
+
+    def start_trace(self, name, traceparent=None, start=None):
+        """ Starts the root span of a request if it's sampled (otherwise returns
+            NOOP_SPAN). A valid traceparent continues the caller's trace.
+        """
+        if not self.exporters:
+            return NOOP_SPAN
+
+        parent = parse_traceparent(traceparent)
+        if parent:
+            (trace_id, parent_id, sampled) = parent
+            if not sampled and not self.__sample():
+                return NOOP_SPAN
+        elif self.__sample():
+            (trace_id, parent_id) = ('%032x' % random.getrandbits(128), None)
+        else:
+            return NOOP_SPAN
+
+        trace_spans = list()
+        span = Span(self, name, trace_id, parent_id, trace_spans, start)
+        trace_spans.append(span)
+        return span
+
+    def current_span(self):
+        return getattr(self.__local, 'span', None) or NOOP_SPAN
+
+    def swap_current_span(self, span):
+        """ Makes span the current span of this thread, returning the previous
+            one.
+        """
+        previous = getattr(self.__local, 'span', None)
+        self.__local.span = span
+        return previous
+
+    def span(self, name):
+        """ Starts a span below the current span, to be used with 'with'. Does
+            nothing unless the current request is being traced.
+        """
+        current = getattr(self.__local, 'span', None)
+        if current is None:
+            return NOOP_SPAN
+        return current.child(name)
+
+    def export(self, spans):
+        for exporter in self.exporters:
+            try:
+                exporter.export(spans)
+            except Exception:
+                logging.exception('Trace exporter failed')
+
+    def __sample(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+
+class RingBufferExporter(object):
+    """ Keeps the most recent traces in memory (e.g. to be viewed from a web
+        service).
+    """
+
+    def __init__(self, capacity=200):
+        self.__traces = collections.deque(maxlen=capacity)
+        self.__lock   = threading.Lock()
+
+    def export(self, spans):
+        with self.__lock:
+            self.__traces.append(spans)
+
+    def get_traces(self):
+        """ The traces held, newest first, each a list of span dictionaries.
+        """
+        with self.__lock:
+            traces = list(self.__traces)
+        return [[span.to_dict() for span in spans] for spans in reversed(traces)]
+
+    def clear(self):
+        with self.__lock:
+            self.__traces.clear()
+
+
+class JsonLinesExporter(object):
+    """ Appends every span to a file as a line of JSON. Background processes
+        write to the same file, so their spans end up alongside the request
+        that caused them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        self.__lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(span.to_dict(), default=str) + '\n' for span in spans)
+        with self.__lock:
+            # Appending in a single write keeps lines from different processes whole
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, lines.encode())
+            finally:
+                os.close(fd)
+
+
+# The tracer used throughout WSBlite, see configure.
+tracer = Tracer()
+
+
+def configure(sample_rate, trace_file=None):
+    """ Turns tracing on for the given fraction of requests. Finished traces are
+        kept in memory (see ring_buffer) and also written to trace_file as JSON
+        lines if given.
+    """
+    tracer.sample_rate = sample_rate
+    if ring_buffer not in tracer.exporters:
+        tracer.add_exporter(ring_buffer)
+    if trace_file:
+        tracer.add_exporter(JsonLinesExporter(trace_file))
+
+
+# The recent traces, viewable through webservices/trace_viewer_example.py
+ring_buffer = RingBufferExporter()
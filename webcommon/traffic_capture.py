@@ -0,0 +1,145 @@
+import base64
+import json
+import logging
+import queue
+import random
+import threading
+import time
+
+# Identifies the first line of a capture file
+CAPTURE_FORMAT  = 'wsblite-capture'
+CAPTURE_VERSION = 1
+
+
+class CapturedRequest(object):
+    """ A request seen by the TrafficRecorder. offset is the number of seconds
+        between the start of the capture and the request arriving, which is what
+        lets a replay keep the original inter-arrival timing. body is None when
+        the body wasn't captured (not sampled or larger than the limit), its
+        size is still recorded.
+    """
+    __slots__ = ('offset', 'method', 'target', 'headers', 'body', 'body_size', 'status', 'duration_ms')
+
+    def __init__(self, offset, method, target, headers, body=None, body_size=0, status=None,
+                 duration_ms=None):
+        self.offset      = offset
+        self.method      = method
+        self.target      = target
+        self.headers     = headers
+        self.body        = body
+        self.body_size   = body_size
+        self.status      = status
+        self.duration_ms = duration_ms
+
+    def to_json(self):
+        return json.dumps({'offset': round(self.offset, 6), 'method': self.method, 'target': self.target,
+                           'headers': self.headers,
+                           'body': base64.b64encode(self.body).decode('ascii') if self.body is not None else None,
+                           'body_size': self.body_size, 'status': self.status, 'duration_ms': self.duration_ms},
+                          separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, line):
+        record = json.loads(line)
+        body = record.get('body')
+        return cls(record['offset'], record['method'], record['target'], [tuple(header) for header in record['headers']],
+                   base64.b64decode(body) if body is not None else None, record.get('body_size', 0),
+                   record.get('status'), record.get('duration_ms'))
+
+
+class TrafficRecorder(object):
+    """ Records the requests reaching the HTTP server (and wsgi_app/asgi_app) to
+        a JSON-lines file so they can be replayed later with replay_traffic.py.
+        Each line holds the method, target, headers, the status sent back and
+        when the request arrived. Bodies of body_sample_rate of the requests
+        are kept, as long as they're no bigger than max_body_bytes.
+
+        The file is written by a thread of its own so request threads never
+        wait on the disk. Note that headers are recorded as they are, including
+        any credentials or cookies.
+    """
+
+    def __init__(self, path, body_sample_rate=1.0, max_body_bytes=4096):
+        self.path             = path
+        self.body_sample_rate = body_sample_rate
+        self.max_body_bytes   = max_body_bytes
+
+        self.__records = queue.Queue()
+        self.__writer  = None
+        self.__started = None
+
+    def start(self):
+        self.__started = time.monotonic()
+        capture_file = open(self.path, 'w', encoding='utf-8')
+        capture_file.write(json.dumps({'format': CAPTURE_FORMAT, 'version': CAPTURE_VERSION,
+                                       'started': time.time()}) + '\n')
+        self.__writer = threading.Thread(target=self.__write_records, args=(capture_file,), daemon=True)
+        self.__writer.start()
+        logging.info('Capturing traffic to ' + self.path)
+
+    def stop(self):
+        if self.__writer:
+            self.__records.put(None)
+            self.__writer.join(5)
+            self.__writer = None
+
+    def start_request(self, request):
+        """ Called as a request arrives, before it's performed. Reads the body now
+            if it's to be captured (the Request keeps it, so the web service
+            still sees it). Returns the CapturedRequest to pass to finish_request.
+        """
+        if self.__writer is None:
+            return None
+
+        offset = time.monotonic() - self.__started
+        headers = list(request.headers.items()) if request.headers else list()
+        try:
+            body_size = int(request.headers.get('content-length', 0)) if request.headers else 0
+        except ValueError:
+            body_size = 0
+
+        body = None
+        if body_size == 0:
+            body = b''
+        elif body_size <= self.max_body_bytes and random.random() < self.body_sample_rate:
+            body = request.body
+        return CapturedRequest(offset, request.method, request.target, headers, body, body_size)
+
+    def finish_request(self, captured, result):
+        """ Records the request once its response has been sent.
+        """
+        if captured is None:
+            return
+        captured.status = int(result.resp_code) if result else None
+        captured.duration_ms = round((time.monotonic() - self.__started - captured.offset) * 1000, 3)
+        self.__records.put(captured)
+
+    def __write_records(self, capture_file):
+        with capture_file:
+            while True:
+                captured = self.__records.get()
+                if captured is None:
+                    break
+                capture_file.write(captured.to_json() + '\n')
+                if self.__records.empty():
+                    capture_file.flush()
+
+
+def read_capture(path):
+    """ Yields the CapturedRequests in a capture file in the order they arrived.
+        They're written as their responses finish, so a slow request comes after
+        quicker ones which arrived later and the whole file is read and sorted
+        by offset first.
+    """
+    with open(path, encoding='utf-8') as capture_file:
+        header = json.loads(capture_file.readline() or '{}')
+        if header.get('format') != CAPTURE_FORMAT:
+            raise ValueError(path + ' is not a WSBlite traffic capture')
+        if header.get('version', 0) > CAPTURE_VERSION:
+            raise ValueError(path + ' was written by a newer version of WSBlite')
+
+        captured_requests = [CapturedRequest.from_json(line) for line in capture_file if line.strip()]
+
+    captured_requests.sort(key=lambda captured: captured.offset)
+    for captured in captured_requests:
+        yield captured
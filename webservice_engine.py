@@ -1,117 +1,741 @@
 import http.server
-import urllib.parse
-import json
+import itertools
 import os
 import logging
+import socket
 import socketserver
+import time
+import math
+import asyncio
+import urllib.parse
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread, Lock
+
+from webcommon import tracing
+from webcommon.base_webservice import BaseWebService, HTTPStatus, ServiceUnavailableError
+from webcommon.http_headers import HeaderMap, HeaderParseError, read_header_block
+from webcommon.process_pool import perform_request_in_worker
+from webcommon.request import Request
+from webcommon.service_bus import ServiceBus
+from webcommon.traffic_capture import TrafficRecorder
+
+
+class TunedServerMixIn(object):
+    """ Applies the socket options given to the server (see SOCKET_OPTIONS) to
+        its listening socket and every connection it accepts.
+    """
+
+    # backlog is the listen queue length, the buffer sizes are in bytes and
+    # tcp_nodelay turns off Nagle's algorithm (TCP only)
+    SOCKET_OPTIONS = ('backlog', 'tcp_nodelay', 'send_buffer_size', 'receive_buffer_size')
 
-from threading import Thread
-from webcommon.base_webservice import BaseWebService, HTTPStatus
+    def __init__(self, server_address, RequestHandlerClass, socket_options=None):
+        self.socket_options = socket_options if socket_options else dict()
+        for name in self.socket_options:
+            if name not in self.SOCKET_OPTIONS:
+                raise ValueError('Unknown socket option: ' + name)
 
+        if self.socket_options.get('backlog'):
+            self.request_queue_size = self.socket_options['backlog']
 
-class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        super().__init__(server_address, RequestHandlerClass)
+
+    def server_bind(self):
+        # Buffer sizes must be set before listening to affect the TCP window
+        self.__set_buffer_sizes(self.socket)
+        super().server_bind()
+
+    def get_request(self):
+        (request, client_address) = super().get_request()
+        self.__set_buffer_sizes(request)
+        if self.socket_options.get('tcp_nodelay') and request.family != socket.AF_UNIX:
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return (request, client_address)
+
+    def __set_buffer_sizes(self, sock):
+        if self.socket_options.get('send_buffer_size'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_options['send_buffer_size'])
+        if self.socket_options.get('receive_buffer_size'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_options['receive_buffer_size'])
+
+
+class ThreadedHTTPServer(TunedServerMixIn, socketserver.ThreadingMixIn, http.server.HTTPServer):
     """ Allows support for asynchronous behaviour (a thread per request)
     """
     allow_reuse_address = True
     daemon_threads = True
 
+    def __init__(self, server_address, RequestHandlerClass, socket_options=None):
+        if ':' in server_address[0]:
+            self.address_family = socket.AF_INET6
+        super().__init__(server_address, RequestHandlerClass, socket_options)
+
+
+class ThreadedUnixHTTPServer(TunedServerMixIn, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ The same as ThreadedHTTPServer but listening on a Unix domain socket,
+        e.g. for a reverse proxy on the same machine.
+    """
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            # Left behind by a previous run
+            os.unlink(self.server_address)
+        super().server_bind()
+        # Used by BaseHTTPRequestHandler in place of a host and port
+        self.server_name = 'localhost'
+        self.server_port = None
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def parse_listen_address(address):
+    """ Converts a listen address - a port number, 'host:port', ':port' (all
+        interfaces) or 'unix:/path/to/socket' - into the server class and server
+        address to use.
+    """
+    if isinstance(address, int):
+        return (ThreadedHTTPServer, ('', address))
+    if address.startswith('unix:'):
+        return (ThreadedUnixHTTPServer, address[len('unix:'):])
+
+    host, _, port = address.rpartition(':')
+    if not port.isdigit():
+        raise ValueError('Listen address must be a port, host:port or unix:/path: ' + address)
+    return (ThreadedHTTPServer, (host.strip('[]'), int(port)))
+
+
+class DeadlineReader(object):
+    """ Wraps the buffered reader of a client's connection so that reading a
+        whole section of the request (e.g. all of the headers) must finish before
+        a deadline, rather than each individual socket read having its own
+        timeout. This stops clients trickling a byte at a time from holding a
+        thread forever.
+    """
+
+    def __init__(self, rfile, connection):
+        self.__rfile      = rfile
+        self.__connection = connection
+        self.__deadline   = None
+
+    def set_deadline(self, timeout):
+        """ Sets how many seconds from now the reads must finish by (None removes
+            the deadline).
+        """
+        self.__deadline = time.monotonic() + timeout if timeout is not None else None
+
+    def peek(self, size=0):
+        self.__arm()
+        return self.__rfile.peek(size)
+
+    def readline(self, limit=-1):
+        parts = list()
+        total = 0
+        while limit < 0 or total < limit:
+            self.__arm()
+            buffered = self.__rfile.peek(1)
+            if not buffered:
+                break
+            newline = buffered.find(b'\n')
+            take = len(buffered) if newline < 0 else newline + 1
+            if limit >= 0:
+                take = min(take, limit - total)
+            # Only takes what is already buffered so never blocks
+            chunk = self.__rfile.read(take)
+            parts.append(chunk)
+            total += len(chunk)
+            if chunk.endswith(b'\n'):
+                break
+        return b''.join(parts)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self.__arm()
+            return self.__rfile.read()
+
+        parts = list()
+        remaining = size
+        while remaining > 0:
+            self.__arm()
+            chunk = self.__rfile.read1(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            parts.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(parts)
+
+    def __arm(self):
+        if self.__deadline is not None:
+            remaining = self.__deadline - time.monotonic()
+            if remaining <= 0:
+                # socket.timeout rather than TimeoutError, they're only the same from 3.10
+                raise socket.timeout('Deadline passed reading from client')
+            self.__connection.settimeout(remaining)
+
+    def __getattr__(self, name):
+        return getattr(self.__rfile, name)
+
 
 class HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
     """ The HTTPRequestHandler acts as the view to the client's requests and is
         the first to be notified. On the client's request, the HTTPRequestHandler
         extracts the required information and passes it to the WebServiceController
     """
+
+    # Payloads up to this size are copied into the same buffer as the headers,
+    # larger ones are written alongside the headers without copying.
+    JOIN_PAYLOAD_LIMIT = 64 * 1024
+
+    # Parse headers with read_header_block rather than the email package.
+    fast_header_parsing    = False
+
+    # Slow client protection. Timeouts are in seconds and apply to the whole of
+    # the headers, the whole of the body and each write of the response.
+    header_timeout          = 10.0
+    body_timeout            = 30.0
+    write_timeout           = 30.0
+    max_request_line_length = 8192
+    max_header_count        = 100
+    max_header_line_length  = 8192
+    max_header_bytes        = 65536
+
+    # Names of the settings above which can be changed with configure_limits
+    LIMIT_SETTINGS = ('header_timeout', 'body_timeout', 'write_timeout', 'max_request_line_length',
+                      'max_header_count', 'max_header_line_length', 'max_header_bytes')
+
+    # Count of each kind of violation seen (shared by all connections)
+    violation_counts = Counter()
+    violation_lock   = Lock()
     
     @classmethod
     def set_controller(cls, controller):
         cls.controller = controller
     
     @classmethod
-    def parse_response(self, raw_response):
+    def configure_limits(cls, **limits):
+        """ Changes the slow client protection settings (see LIMIT_SETTINGS).
+        """
+        for name, value in limits.items():
+            if name not in cls.LIMIT_SETTINGS:
+                raise ValueError('Unknown request limit: ' + name)
+            setattr(cls, name, value)
+
+    @classmethod
+    def record_violation(cls, violation):
+        with cls.violation_lock:
+            cls.violation_counts[violation] += 1
+
+    @classmethod
+    def get_violation_counts(cls):
+        with cls.violation_lock:
+            return dict(cls.violation_counts)
+    
+    @staticmethod
+    def parse_response(raw_response):
         return None  
-         
-    def get_payload(self):
+
+    def address_string(self):
+        # Clients connected through a Unix socket have no address of their own
+        if not isinstance(self.client_address, tuple):
+            return 'unix:' + str(self.server.server_address)
+        return super().address_string()
+
+    def setup(self):
+        super().setup()
+        self.rfile = DeadlineReader(self.rfile, self.connection)
+        self.__phase = None
+        self.__extra_headers = ()
+
+    def handle_one_request(self):
+        """ Handles a single request, enforcing the request line, header and
+            timeout limits. Clients breaking them are sent a 408/414/431 (when
+            possible) and disconnected.
+        """
+        # Same as BaseHTTPRequestHandler, until the request line is parsed any
+        # error is sent with a HTTP/1.0 style status line.
+        self.command         = None
+        self.request_version = ''
+        self.requestline     = ''
+        self.__extra_headers = ()
+        self.__phase         = 'idle'
+        self.rfile.set_deadline(self.header_timeout)
+
+        try:
+            # Waits for the next request, the header timeout starts once it arrives
+            if not self.rfile.peek(1):
+                self.close_connection = True
+                return
+            self.__phase = 'header'
+            self.rfile.set_deadline(self.header_timeout)
+
+            self.raw_requestline = self.rfile.readline(self.max_request_line_length + 1)
+            if len(self.raw_requestline) > self.max_request_line_length:
+                self.__reject(HTTPStatus.REQUEST_URI_TOO_LONG, 'request_line_too_long')
+                return
+            if not self.raw_requestline:
+                self.close_connection = True
+                return
+            parse_start = time.time()
+            if not self.parse_request():
+                return
+            if not self.__headers_within_limits():
+                return
+
+            self.rfile.set_deadline(None)
+            self.__phase = None
+
+            method_name = 'do_' + self.command
+            if not hasattr(self, method_name):
+                self.send_error(HTTPStatus.NOT_IMPLEMENTED, 'Unsupported method (%r)' % self.command)
+                return
+
+            with self.__start_trace(parse_start):
+                getattr(self, method_name)()
+                self.wfile.flush()
+        except socket.timeout:
+            self.__handle_timeout()
+
+    def send_error(self, code, message=None, explain=None):
+        """ Counts limit violations found by BaseHTTPRequestHandler itself (e.g.
+            its own maximum number of headers) before sending the error, under the
+            same names the fast header parser uses.
+        """
+        if code == HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE:
+            self.record_violation('too_many_headers' if message == 'Too many headers' else 'headers_too_large')
+        elif code == HTTPStatus.REQUEST_URI_TOO_LONG:
+            self.record_violation('request_line_too_long')
+        self.__send_error_to_client(code, message, explain)
+
+    def read_body(self):
+        """ Reads the raw request body as declared by the Content-Length header.
+            The whole body must arrive within the body timeout.
+        """
         content_len = int(self.headers.get('content-length', 0))
-        raw_message_body = self.rfile.read(content_len)
-        
+
+        self.__phase = 'body'
+        self.rfile.set_deadline(self.body_timeout)
+        body = self.rfile.read(content_len)
+        self.rfile.set_deadline(None)
+        self.__phase = None
+
+        return body
+
+    def iter_body(self, chunk_size=65536):
+        """ Reads the request body in chunks of up to chunk_size bytes. The whole
+            body must still arrive within the body timeout.
+        """
+        remaining = int(self.headers.get('content-length', 0))
+
+        self.__phase = 'body'
+        self.rfile.set_deadline(self.body_timeout)
+        try:
+            while remaining > 0:
+                chunk = self.rfile.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            if remaining > 0:
+                # The rest of the body is still waiting on the connection
+                self.close_connection = True
+            self.rfile.set_deadline(None)
+            self.__phase = None
+
+    def get_payload(self):
         content_type = self.headers.get('content-type', '')
-        message_body = None
-        if content_type == 'application/json':
-            message_body = json.loads(raw_message_body.decode())
-        else:
-            message_body = urllib.parse.unquote_plus(raw_message_body.decode())
-        
+        message_body = Request.decode_payload(content_type, self.read_body())
+
         return (content_type, message_body)
+
+    def parse_request(self):
+        """ Parses the request line and headers. Unless fast header parsing has been
+            enabled this is left to BaseHTTPRequestHandler, which builds the headers
+            through the (comparatively slow) email package.
+        """
+        if not self.fast_header_parsing:
+            return super().parse_request()
+
+        self.command = None
+        self.request_version = version = self.default_request_version
+        self.close_connection = True
+
+        requestline = str(self.raw_requestline, 'iso-8859-1').rstrip('\r\n')
+        self.requestline = requestline
+        words = requestline.split()
+        if len(words) == 0:
+            return False
+
+        if len(words) >= 3:
+            version = words[-1]
+            try:
+                if not version.startswith('HTTP/'):
+                    raise ValueError
+                major, minor = version.split('/', 1)[1].split('.')
+                version_number = (int(major), int(minor))
+            except (ValueError, IndexError):
+                self.send_error(HTTPStatus.BAD_REQUEST, 'Bad request version (%r)' % version)
+                return False
+            if version_number >= (1, 1) and self.protocol_version >= 'HTTP/1.1':
+                self.close_connection = False
+            if version_number >= (2, 0):
+                self.send_error(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED, 'Invalid HTTP version (%s)' % version)
+                return False
+            self.request_version = version
+
+        if not 2 <= len(words) <= 3:
+            self.send_error(HTTPStatus.BAD_REQUEST, 'Bad request syntax (%r)' % requestline)
+            return False
+        command, path = words[:2]
+        if len(words) == 2:
+            self.close_connection = True
+            if command != 'GET':
+                self.send_error(HTTPStatus.BAD_REQUEST, 'Bad HTTP/0.9 request type (%r)' % command)
+                return False
+        self.command, self.path = command, path
+
+        # Same as BaseHTTPRequestHandler, stop '//' at the start of the path being
+        # treated as a network location.
+        if self.path.startswith('//'):
+            self.path = '/' + self.path.lstrip('/')
+
+        try:
+            self.headers = read_header_block(self.rfile, self.max_header_count,
+                                             self.max_header_line_length, self.max_header_bytes)
+        except HeaderParseError as err:
+            self.__reject(err.resp_code, err.violation, err.message)
+            return False
+
+        connection_type = self.headers.get('Connection', '').lower()
+        if connection_type == 'close':
+            self.close_connection = True
+        elif connection_type == 'keep-alive' and self.protocol_version >= 'HTTP/1.1':
+            self.close_connection = False
+
+        expect = self.headers.get('Expect', '').lower()
+        if (expect == '100-continue' and self.protocol_version >= 'HTTP/1.1'
+                and self.request_version >= 'HTTP/1.1'):
+            if not self.handle_expect_100():
+                return False
+        return True
     
     def do_GET(self):
         """ Serves a GET request.
         """
-        controller = HTTPRequestHandler.controller
-        
-        if 'favicon.ico' in self.path:
-            favicon_path = os.path.join(controller._resource_dir, 'favicon.ico')
-            if os.path.exists(favicon_path):
-                img_data = open(favicon_path, 'rb').read()
-                img_resp = BaseWebService.ServiceResponse(payload=img_data,
-                                                          add_html_wrapper=False,
-                                                          content_type='image/x-icon')
-                self.__handle_result(img_resp)
-            else:
-                logging.info('Client requested favicon but nothing found here: ' + favicon_path)
-        else:
-            
-            result = controller.perform_client_request(self, 'GET', self.path, self.headers)
-            self.__handle_result(result)
+        self.__perform_request_or_serve_favicon('GET')
             
     def do_POST(self):
         """ Serves a POST request.
         """
-        (payload_type, payload_content) = self.get_payload()
-        
-        controller = HTTPRequestHandler.controller
-        result = controller.perform_client_request(self, 'POST', self.path, self.headers, payload_type,
-                                                   payload_content)
-        self.__handle_result(result)
+        self.__perform_request('POST')
         
     def do_PUT(self):
         """ Serves a PUT request.
         """
-        (payload_type, payload_content) = self.get_payload()
-        
-        controller = HTTPRequestHandler.controller
-        result = controller.perform_client_request(self, 'PUT', self.path, self.headers, payload_type,
-                                                   payload_content)
-        self.__handle_result(result)
+        self.__perform_request('PUT')
         
     def do_DELETE(self):
         """ Serves a DELETE request.
         """
+        self.__perform_request('DELETE')
+
+    def do_PATCH(self):
+        """ Serves a PATCH request.
+        """
+        self.__perform_request('PATCH')
+
+    def do_HEAD(self):
+        """ Serves a HEAD request, sending the headers a GET would without the
+            body.
+        """
+        self.__perform_request_or_serve_favicon('HEAD')
+
+    def do_OPTIONS(self):
+        """ Serves an OPTIONS request (including CORS preflight requests).
+        """
+        self.__perform_request('OPTIONS')
+
+    def __perform_request_or_serve_favicon(self, method):
+        if 'favicon.ico' in self.path:
+            img_resp = HTTPRequestHandler.controller.get_favicon_response()
+            if img_resp:
+                self.__handle_result(img_resp)
+        else:
+            self.__perform_request(method)
+
+    def __perform_request(self, method):
+        """ Hands the request to the controller. The body, query string etc. are
+            only parsed if the web service which handles the request asks for them.
+        """
         controller = HTTPRequestHandler.controller
-        result = controller.perform_client_request(self, 'DELETE', self.path, self.headers)
+        request = Request(method, self.path, self.headers, handler=self)
+
+        recorder = controller.traffic_recorder
+        captured = recorder.start_request(request) if recorder else None
+
+        result = controller.perform_request(request)
+        self.__extra_headers = controller.get_cors_headers(self.headers)
         self.__handle_result(result)
+
+        if captured:
+            recorder.finish_request(captured, result)
         
             
     def __handle_result(self, result):
-        self.__send_response(result)
+        self.__phase = 'write'
+        self.connection.settimeout(self.write_timeout)
+        with tracing.tracer.span('write_response') as span:
+            if result:
+                span.set_attribute('status', int(result.resp_code))
+            self.__send_response(result)
+        self.__phase = None
+
+    def __start_trace(self, parse_start):
+        """ Starts the trace of this request (if it's sampled), including the
+            time already spent parsing the headers.
+        """
+        if not tracing.tracer.exporters:
+            return tracing.NOOP_SPAN
+
+        span = tracing.tracer.start_trace(self.command + ' ' + self.path.partition('?')[0],
+                                          self.headers.get('traceparent'), start=parse_start)
+        span.child('parse_headers', start=parse_start).finish()
+        return span
+
+    def __headers_within_limits(self):
+        """ The fast parser enforces the header limits as it reads, this checks
+            them for headers read by BaseHTTPRequestHandler (which also applies
+            http.client's own limits of 100 headers and 65536 bytes a line).
+        """
+        if self.fast_header_parsing:
+            return True
+
+        # Measured as the fast parser does, 'Name: value' plus the line ending
+        if any(len(name) + len(value) + 4 > self.max_header_line_length
+               for (name, value) in self.headers.items()):
+            self.__reject(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, 'headers_too_large', 'Header line too long')
+            return False
+
+        if len(self.headers) > self.max_header_count:
+            self.__reject(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, 'too_many_headers', 'Too many headers')
+            return False
+
+        header_bytes = sum(len(name) + len(value) + 4 for (name, value) in self.headers.items())
+        if header_bytes > self.max_header_bytes:
+            self.__reject(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, 'headers_too_large',
+                          'Header block too large')
+            return False
+
+        return True
+
+    def __handle_timeout(self):
+        """ Called when the client was too slow sending its request or reading the
+            response. A 408 is sent if the response hasn't been started. A kept
+            alive connection which sent no further request is simply closed.
+        """
+        self.close_connection = True
+        if self.__phase == 'idle':
+            logging.debug('Closing idle connection from client ' + self.address_string())
+        elif self.__phase in ('header', 'body'):
+            try:
+                self.__reject(HTTPStatus.REQUEST_TIMEOUT, self.__phase + '_timeout')
+            except OSError:
+                pass
+        else:
+            self.record_violation('write_timeout')
+            logging.info('Timed out writing response to client ' + self.address_string())
+
+    def __reject(self, resp_code, violation, message=None):
+        """ Counts the violation and sends the client an error before closing
+            the connection.
+        """
+        logging.info('Rejecting client ' + self.address_string() + ': ' + violation)
+        self.record_violation(violation)
+        self.close_connection = True
+        self.connection.settimeout(self.write_timeout)
+        self.__send_error_to_client(resp_code, message)
+
+    def __send_error_to_client(self, code, message=None, explain=None):
+        super().send_error(code, message, explain)
             
         
     def __send_response(self, service_resp):
         """ Sends a HTTP response back to the user with a format defined by the
             caller. If service_resp is None then nothing is sent back to the client.
+            The status line, headers and body are handed to the socket together
+            so that small responses go out in a single send.
+        """
+        if self.command == 'HEAD' and service_resp:
+            # Same headers as the GET would have, but no body
+            self.wfile.write(self.__build_response_head(service_resp.resp_code, service_resp.get_headers()))
+            if isinstance(service_resp, BaseWebService.StreamingServiceResponse):
+                service_resp.close()
+        elif isinstance(service_resp, BaseWebService.StreamingServiceResponse):
+            self.__send_streaming_response(service_resp)
+        elif service_resp:
+            head = self.__build_response_head(service_resp.resp_code, service_resp.get_headers())
+            self.__write_buffers(head, service_resp.payload)
+
+    def __send_streaming_response(self, service_resp):
+        """ Sends the headers of a streaming response and then writes each chunk
+            of the body as soon as it is produced. Stops quietly if the client
+            goes away.
+        """
+        if (service_resp.content_length is None
+                and service_resp.resp_code not in BaseWebService.ServiceResponse.BODYLESS_RESP_CODES):
+            self.close_connection = True
+
+        chunks = service_resp.iter_chunks()
+        try:
+            self.wfile.write(self.__build_response_head(service_resp.resp_code, service_resp.get_headers()))
+            for chunk in chunks:
+                self.wfile.write(chunk)
+        except OSError as err:
+            if isinstance(err, socket.timeout):
+                self.record_violation('write_timeout')
+            logging.debug('Client disconnected from streaming response')
+            self.close_connection = True
+        finally:
+            chunks.close()
+
+    def __build_response_head(self, resp_code, headers):
+        """ Builds the status line and headers of a response as a single block of
+            bytes (the same headers send_response/send_header would produce).
         """
-        if service_resp:
-            self.send_response(service_resp.resp_code)
-            if service_resp.payload:
-                self.send_header("Content-type", service_resp.content_type)
-                self.send_header("Content-Length", len(service_resp.payload))
+        self.log_request(resp_code)
+
+        lines = ['%s %d %s' % (self.protocol_version, resp_code, getattr(resp_code, 'phrase', '')),
+                 'Server: ' + self.version_string(),
+                 'Date: ' + self.date_time_string()]
+
+        for header_key, header_value in itertools.chain(headers, self.__extra_headers):
+            lines.append('%s: %s' % (header_key, header_value))
+            if header_key.lower() == 'connection':
+                if header_value.lower() == 'close':
+                    self.close_connection = True
+                elif header_value.lower() == 'keep-alive':
+                    self.close_connection = False
+
+        lines.append('\r\n')
+        return '\r\n'.join(lines).encode('latin-1', 'strict')
+
+    def __write_buffers(self, head, payload):
+        """ Writes the response head and body to the client. Small responses are
+            joined into one buffer, large payloads are sent alongside the head
+            with a single gathered write rather than being copied.
+        """
+        if not payload:
+            self.wfile.write(head)
+        elif len(payload) <= self.JOIN_PAYLOAD_LIMIT:
+            self.wfile.write(b''.join((head, payload)))
+        else:
+            try:
+                buffers = [memoryview(head), memoryview(payload)]
+                while buffers:
+                    sent = self.connection.sendmsg(buffers)
+                    while buffers and sent >= len(buffers[0]):
+                        sent -= len(buffers.pop(0))
+                    if buffers:
+                        buffers[0] = buffers[0][sent:]
+            except (AttributeError, NotImplementedError):
+                # The connection doesn't support gathered writes (e.g. TLS)
+                self.wfile.write(head)
+                self.wfile.write(payload)
+
+
+class _WsgiConnection(object):
+    """ Stands in for the HTTPRequestHandler when a request arrives through
+        wsgi_app, providing the request body and client address.
+    """
+
+    def __init__(self, environ):
+        self.__environ = environ
+        self.client_address = (environ.get('REMOTE_ADDR'), environ.get('REMOTE_PORT'))
+
+    def read_body(self):
+        return b''.join(self.iter_body())
+
+    def iter_body(self, chunk_size=65536):
+        try:
+            remaining = int(self.__environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            remaining = 0
+        while remaining > 0:
+            chunk = self.__environ['wsgi.input'].read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+class _AsgiConnection(object):
+    """ Stands in for the HTTPRequestHandler when a request arrives through
+        asgi_app. The body is received from the event loop only if the web
+        service asks for it.
+    """
+
+    def __init__(self, scope, receive, loop):
+        self.__receive = receive
+        self.__loop    = loop
+        self.client_address = tuple(scope['client']) if scope.get('client') else None
 
-            # Send any additional headers the user has specifically requested.
-            for header_key, header_value in service_resp.add_headers.items():
-                self.send_header(header_key, header_value)
+    def read_body(self):
+        return b''.join(self.iter_body())
 
-            self.end_headers()
+    def iter_body(self, chunk_size=None):
+        # Chunks are yielded as the ASGI server delivers them
+        more_body = True
+        while more_body:
+            message = asyncio.run_coroutine_threadsafe(self.__receive(), self.__loop).result()
+            if message['type'] != 'http.request':
+                break
+            more_body = message.get('more_body', False)
+            if message.get('body'):
+                yield message['body']
 
-            self.wfile.write(service_resp.payload)
+
+def _request_target_from_environ(environ):
+    """ Rebuilds the (still url encoded) request target the HTTP server would
+        have seen from a WSGI environ.
+    """
+    target = environ.get('RAW_URI') or environ.get('REQUEST_URI')
+    if target:
+        return target
+
+    path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+    if path == '*':
+        # OPTIONS * asks about the server as a whole
+        return path
+    target = urllib.parse.quote(path.encode('latin-1')) or '/'
+    if environ.get('QUERY_STRING'):
+        target += '?' + environ['QUERY_STRING']
+    return target
+
+
+def _headers_from_environ(environ):
+    headers = HeaderMap()
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            headers.add(key[5:].replace('_', '-').title(), value)
+        elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH') and value:
+            headers.add(key.replace('_', '-').title(), value)
+    return headers
+
+
+def _request_target_from_scope(scope):
+    raw_path = scope.get('raw_path')
+    if raw_path:
+        target = raw_path.decode('latin-1')
+    else:
+        target = urllib.parse.quote(scope.get('root_path', '') + scope['path'])
+    if scope.get('query_string'):
+        target += '?' + scope['query_string'].decode('latin-1')
+    return target
 
 
 class WebServiceController(object):
@@ -122,34 +746,66 @@ class WebServiceController(object):
     """
     
     
+    # CORS settings which can be given to the controller, with their defaults.
+    # allow_origins may contain '*' to allow any origin, but not when credentials
+    # are allowed (any site could then make requests with the user's cookies).
+    CORS_SETTINGS = {'allow_origins': ('*',), 'allow_headers': ('Content-Type', 'Authorization'),
+                     'expose_headers': (), 'allow_credentials': False, 'max_age': 600}
+
+    # Most OPTIONS responses kept (they are built once per path and origin)
+    OPTIONS_CACHE_SIZE = 1024
+
     def __init__(self, port, web_service_classes,
                  resource_dir=os.path.abspath(os.path.join(os.path.dirname(__file__), 
-                                                           'resources'))):
+                                                           'resources')),
+                 fast_header_parsing=False, request_limits=None, process_pool_workers=None,
+                 listen_addresses=None, socket_options=None, traffic_capture=None, cors=None):
         """ Instantiates all web services and also adds them ta a lookup to allow
             rapid searches for the correct web service to handle incoming requests.
+            The process pool (shared by any web services configured to use it) has
+            process_pool_workers processes, one per CPU if not given.
+
+            The HTTP server listens on every one of the listen_addresses (see
+            parse_listen_address) or on the port if none are given. socket_options
+            is a dictionary of TunedServerMixIn.SOCKET_OPTIONS.
+
+            traffic_capture records the requests received to a file for
+            replay_traffic.py, it's a dictionary of the arguments of
+            webcommon.traffic_capture.TrafficRecorder (at least its path).
+
+            OPTIONS requests are answered from the methods each path allows. Pass
+            cors (a dictionary of CORS_SETTINGS, which can be empty to take the
+            defaults) to also answer browsers' CORS preflight requests and allow
+            cross-origin requests.
         """
         
         self._port                = port
+        self.service_bus          = ServiceBus(self)
         self._loaded_web_services = self.__instantiate_web_services(web_service_classes)
         self._web_service_lookup  = self.__create_web_service_lookup(self._loaded_web_services)
-        self._server_address      = None
+        self._listen_addresses    = listen_addresses if listen_addresses else [port]
+        self._socket_options      = socket_options if socket_options else dict()
         self._resource_dir        = resource_dir
+        self._fast_header_parsing = fast_header_parsing
+        self._request_limits      = request_limits if request_limits else dict()
+        self._process_pool_workers = process_pool_workers
+        self.traffic_recorder     = TrafficRecorder(**traffic_capture) if traffic_capture else None
+        self._cors                = self.__create_cors_settings(cors)
+
+        self.__options_cache      = dict()
+        self.__cors_headers_cache = dict()
         
-        self.__server_thread  = None
-        self.__server         = None
+        self.__process_pool     = None
+        self.__server_threads   = list()
+        self.__servers          = list()
+        self.__services_started = False
+        self.__services_lock    = Lock()
         
     def start(self):
         """ Starts the controller which in turn starts all of the web services
             and then finally the HTTP server.
         """
-        for web_service in self._loaded_web_services:
-            # Initialise all services to make them aware of other services
-            # running before they are actually started.
-            web_service.initialise(self._loaded_web_services)
-            
-        for web_service in self._loaded_web_services:
-            web_service.start()
-            
+        self.start_services()
         self.__start_server()
         
     def stop(self):
@@ -157,44 +813,380 @@ class WebServiceController(object):
             finally stops the web services.
         """
         self.__stop_server()
-        for web_service in self._loaded_web_services:
-            web_service.stop()
+        self.stop_services()
+
+    def start_services(self):
+        """ Initialises and starts all of the web services (and so their
+            background processes) without starting the HTTP server. Use this when
+            serving through wsgi_app or asgi_app instead.
+        """
+        with self.__services_lock:
+            if self.__services_started:
+                return
+
+            if any(web_service.use_process_pool for web_service in self._loaded_web_services):
+                self.__process_pool = ProcessPoolExecutor(max_workers=self._process_pool_workers)
+
+            for web_service in self._loaded_web_services:
+                # Initialise all services to make them aware of other services
+                # running before they are actually started.
+                web_service.initialise(self._loaded_web_services)
+                
+            for web_service in self._loaded_web_services:
+                web_service.start()
+
+            if self.traffic_recorder:
+                self.traffic_recorder.start()
+
+            self.__services_started = True
+
+    def stop_services(self):
+        """ Stops all of the web services.
+        """
+        with self.__services_lock:
+            if not self.__services_started:
+                return
+
+            if self.traffic_recorder:
+                self.traffic_recorder.stop()
+
+            for web_service in self._loaded_web_services:
+                web_service.stop()
+
+            if self.__process_pool:
+                self.__process_pool.shutdown(wait=True)
+                self.__process_pool = None
+
+            self.__services_started = False
         
     def is_server_running(self):
-        return self.__server_thread.isAlive()
+        return any(server_thread.is_alive() for server_thread in self.__server_threads)
     
     def wait_here_until_server_thread_stops(self):
-        self.__server_thread.join()
+        for server_thread in self.__server_threads:
+            server_thread.join()
+
+    def get_server_addresses(self):
+        """ The addresses the HTTP server is listening on (with the port actually
+            bound when port 0 was asked for).
+        """
+        return [server.socket.getsockname() for server in self.__servers]
     
     def parse_response(self, raw_response):
-        return self.__server.RequestHandlerClass.parse_response(raw_response)
+        return HTTPRequestHandler.parse_response(raw_response)
+
+    def get_violation_counts(self):
+        """ Returns how many clients have been disconnected for breaking each of
+            the request limits (timeouts, header sizes etc.)
+        """
+        return HTTPRequestHandler.get_violation_counts()
     
+    def get_favicon_response(self):
+        """ Returns the favicon from the resource directory (or None if there
+            isn't one).
+        """
+        favicon_path = os.path.join(self._resource_dir, 'favicon.ico')
+        if not os.path.exists(favicon_path):
+            logging.info('Client requested favicon but nothing found here: ' + favicon_path)
+            return None
+
+        with open(favicon_path, 'rb') as favicon:
+            img_data = favicon.read()
+        return BaseWebService.ServiceResponse(payload=img_data, add_html_wrapper=False,
+                                              content_type='image/x-icon')
+
+    def wsgi_app(self, environ, start_response):
+        """ A WSGI application serving the web services, so they can be run by
+            any WSGI server (or called directly, without a socket, in tests). Call
+            start_services first (and stop_services when finished).
+        """
+        request = Request(environ['REQUEST_METHOD'], _request_target_from_environ(environ),
+                          _headers_from_environ(environ), handler=_WsgiConnection(environ))
+        result = self.__perform_gateway_request(request)
+
+        status = '%d %s' % (result.resp_code, getattr(result.resp_code, 'phrase', ''))
+        start_response(status, [(name, str(value)) for (name, value)
+                                in itertools.chain(result.get_headers(), self.get_cors_headers(request.headers))])
+
+        if request.method == 'HEAD':
+            if isinstance(result, BaseWebService.StreamingServiceResponse):
+                result.close()
+            return []
+        if isinstance(result, BaseWebService.StreamingServiceResponse):
+            # The server closes the generator (and so the stream) when it is done
+            return result.iter_chunks()
+        return [result.payload]
+
+    async def asgi_app(self, scope, receive, send):
+        """ An ASGI application serving the web services. The web services are
+            started and stopped by the server's lifespan events (if it sends them)
+            and run on the event loop's default executor so they can block.
+        """
+        loop = asyncio.get_event_loop()
+
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await loop.run_in_executor(None, self.start_services)
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await loop.run_in_executor(None, self.stop_services)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type: ' + scope['type'])
+
+        request = Request(scope['method'], _request_target_from_scope(scope),
+                          HeaderMap([(name.decode('latin-1'), value.decode('latin-1'))
+                                     for (name, value) in scope.get('headers', [])]),
+                          handler=_AsgiConnection(scope, receive, loop))
+        result = await loop.run_in_executor(None, self.__perform_gateway_request, request)
+
+        await send({'type': 'http.response.start',
+                    'status': int(result.resp_code),
+                    'headers': [(name.lower().encode('latin-1'), str(value).encode('latin-1'))
+                                for (name, value) in itertools.chain(result.get_headers(),
+                                                                     self.get_cors_headers(request.headers))]})
+
+        if request.method == 'HEAD':
+            if isinstance(result, BaseWebService.StreamingServiceResponse):
+                result.close()
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        if not isinstance(result, BaseWebService.StreamingServiceResponse):
+            await send({'type': 'http.response.body', 'body': bytes(result.payload)})
+            return
+
+        chunks = result.iter_chunks()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await loop.run_in_executor(None, chunks.close)
+
+    def __perform_gateway_request(self, request):
+        """ Performs a request received through wsgi_app/asgi_app, which (unlike
+            the HTTP server) must always send something back.
+        """
+        captured = self.traffic_recorder.start_request(request) if self.traffic_recorder else None
+
+        if request.method in ('GET', 'HEAD') and 'favicon.ico' in request.path:
+            result = self.get_favicon_response()
+        else:
+            result = self.perform_request(request)
+
+        if result is None:
+            logging.info('No response given for ' + request.path)
+            result = BaseWebService.RESPONSE_NOT_FOUND
+
+        if captured:
+            self.traffic_recorder.finish_request(captured, result)
+        return result
+
     def perform_client_request(self, handler, method, path, headers, payload_type=None, payload_content=None):
+        """ Kept for callers which pass the request as separate arguments, see
+            perform_request.
+        """
+        request = Request(method, path, headers, handler=handler, payload=(payload_type, payload_content))
+        return self.perform_request(request)
+
+    def perform_request(self, request):
         """ Called when the HTTPRequestHandler receives a request from a client.
             This is where the controller looks to see which web service should
-            handle the client's request. 
+            handle the client's request. Only the path (never the query string)
+            is used to find the web service.
         """
+        method  = request.method
+        path    = request.path
+        headers = request.headers
 
         if '//' in path:
             # Double slash in the URL path should give a BAD REQUEST
-            return BaseWebService.ServiceResponse(resp_code=HTTPStatus.BAD_REQUEST)
+            return BaseWebService.RESPONSE_BAD_REQUEST
+
+        if method not in self._web_service_lookup:
+            return BaseWebService.RESPONSE_METHOD_NOT_ALLOWED
+
+        if not path.startswith('/'):
+            # Only 'OPTIONS *' (about the server as a whole) has no path
+            if method == 'OPTIONS' and path == '*':
+                return self.__get_options_response(path, headers)
+            return BaseWebService.RESPONSE_BAD_REQUEST
 
-        selected_web_service = self.__get_web_service_that_owns_path(path, self._web_service_lookup[method])
+        with tracing.tracer.span('route'):
+            selected_web_service = self.__get_web_service_that_owns_path(path, self._web_service_lookup[method])
+
+        if selected_web_service is None and method == 'OPTIONS':
+            # No web service answers OPTIONS itself for this path
+            return self.__get_options_response(path, headers)
 
         if selected_web_service:
-            if selected_web_service.auth_all_enabled:
-                auth_passed = selected_web_service.check_authentication(path, headers)
-            else:
-                logging.info('Authentication is disabled for all owned urls for: ' + selected_web_service.service_name)
-                auth_passed = True
+            if method == 'HEAD' and not selected_web_service.handles_head_requests:
+                # Performed as a GET, the body is left out when the response is sent
+                request = Request('GET', request.target, headers, handler=request.handler)
+
+            with tracing.tracer.span('authenticate'):
+                if selected_web_service.auth_all_enabled:
+                    auth_passed = selected_web_service.check_authentication(path, headers)
+                else:
+                    logging.info('Authentication is disabled for all owned urls for: ' + selected_web_service.service_name)
+                    auth_passed = True
 
             if not auth_passed:
                 return selected_web_service.request_authentication(realm=selected_web_service.service_name)
 
-            return selected_web_service.perform_client_request(handler, method, path, headers, payload_type,
-                                                               payload_content)
+            try:
+                with tracing.tracer.span('perform_request') as span:
+                    span.set_attribute('service', selected_web_service.service_name)
+                    if selected_web_service.use_process_pool and self.__process_pool:
+                        result = self.__perform_request_in_process_pool(selected_web_service, request)
+                    else:
+                        result = selected_web_service.perform_request(request)
+            except ServiceUnavailableError as err:
+                logging.info(str(err))
+                if err.retry_after is None:
+                    return BaseWebService.RESPONSE_SERVICE_UNAVAILABLE
+                return BaseWebService.ServiceResponse(resp_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                                                      add_headers={'Retry-After': max(1, math.ceil(err.retry_after))})
+            if method in ('GET', 'HEAD'):
+                result = self.__apply_conditional_get(selected_web_service, result, headers)
+
+            return result
         else:
-            return BaseWebService.ServiceResponse(resp_code=HTTPStatus.NOT_FOUND)
+            return BaseWebService.RESPONSE_NOT_FOUND
+
+    def get_cors_headers(self, request_headers):
+        """ The CORS headers to add to the response to a request, none unless
+            CORS is enabled and the request came from an allowed origin.
+        """
+        if self._cors is None or not request_headers:
+            return ()
+        origin = request_headers.get('Origin')
+        if not origin:
+            return ()
+
+        cors_headers = self.__cors_headers_cache.get(origin)
+        if cors_headers is None:
+            allowed_origin = self.__get_allowed_origin(origin)
+            cors_headers = list()
+            if allowed_origin:
+                cors_headers.append(('Access-Control-Allow-Origin', allowed_origin))
+                if allowed_origin != '*':
+                    cors_headers.append(('Vary', 'Origin'))
+                if self._cors['allow_credentials']:
+                    cors_headers.append(('Access-Control-Allow-Credentials', 'true'))
+                if self._cors['expose_headers']:
+                    cors_headers.append(('Access-Control-Expose-Headers', ', '.join(self._cors['expose_headers'])))
+            cors_headers = tuple(cors_headers)
+            if len(self.__cors_headers_cache) >= self.OPTIONS_CACHE_SIZE:
+                self.__cors_headers_cache.clear()
+            self.__cors_headers_cache[origin] = cors_headers
+        return cors_headers
+
+    def __get_options_response(self, path, headers):
+        """ Answers an OPTIONS request with the methods allowed for the path and,
+            for CORS preflight requests, the CORS headers. The web services never
+            change once loaded so each response is built once and shared.
+        """
+        origin = headers.get('Origin') if headers and self._cors is not None else None
+        preflight_origin = None
+        if origin and headers.get('Access-Control-Request-Method'):
+            preflight_origin = self.__get_allowed_origin(origin)
+
+        cache_key = (path, preflight_origin is not None)
+        response = self.__options_cache.get(cache_key)
+        if response is not None:
+            return response
+
+        allowed_methods = self.__get_allowed_methods(path)
+        if not allowed_methods:
+            response = BaseWebService.RESPONSE_NOT_FOUND
+        else:
+            options_headers = {'Allow': ', '.join(allowed_methods)}
+            if preflight_origin:
+                # get_cors_headers adds the origin itself when the response is sent
+                options_headers['Access-Control-Allow-Methods'] = ', '.join(allowed_methods)
+                options_headers['Access-Control-Max-Age'] = str(self._cors['max_age'])
+                if self._cors['allow_headers']:
+                    options_headers['Access-Control-Allow-Headers'] = ', '.join(self._cors['allow_headers'])
+            response = BaseWebService.FrozenServiceResponse(resp_code=HTTPStatus.NO_CONTENT,
+                                                            add_headers=options_headers)
+
+        if len(self.__options_cache) >= self.OPTIONS_CACHE_SIZE:
+            self.__options_cache.clear()
+        self.__options_cache[cache_key] = response
+        return response
+
+    def __get_allowed_methods(self, path):
+        """ The methods some web service allows for the path (any path for
+            'OPTIONS *'), in the order of BaseWebService.HTTP_METHODS.
+        """
+        allowed_methods = list()
+        for method in BaseWebService.HTTP_METHODS:
+            if path == '*':
+                owned = bool(self._web_service_lookup[method])
+            else:
+                owned = self.__get_web_service_that_owns_path(path, self._web_service_lookup[method]) is not None
+            if owned or method == 'OPTIONS':
+                allowed_methods.append(method)
+        # OPTIONS on its own means nothing owns the path
+        return allowed_methods if len(allowed_methods) > 1 else []
+
+    def __get_allowed_origin(self, origin):
+        """ The value of Access-Control-Allow-Origin for an origin, or None if the
+            origin isn't allowed.
+        """
+        if '*' in self._cors['allow_origins']:
+            return '*'
+        if origin in self._cors['allow_origins']:
+            return origin
+        return None
+
+    def __create_cors_settings(self, cors):
+        if cors is None:
+            return None
+        for name in cors:
+            if name not in self.CORS_SETTINGS:
+                raise ValueError('Unknown CORS setting: ' + name)
+        settings = dict(self.CORS_SETTINGS)
+        settings.update(cors)
+        if settings['allow_credentials'] and '*' in settings['allow_origins']:
+            raise ValueError('CORS allow_credentials needs the allowed origins listed in allow_origins, not *')
+        return settings
+
+    def __perform_request_in_process_pool(self, web_service, request):
+        """ Performs the request in the shared process pool, leaving this thread
+            (and the GIL) free while the worker is busy. The worker has its own
+            instance of the web service so only stateless web services should be
+            configured to use the pool.
+        """
+        future = self.__process_pool.submit(perform_request_in_worker, type(web_service), request.detach())
+        return future.result()
+
+    def __apply_conditional_get(self, web_service, result, headers):
+        """ Tags a successful response with a strong ETag (computed from the
+            payload unless the service supplied one) and replaces it with a
+            bodyless 304 if the client already holds that representation.
+        """
+        if (not result or result.resp_code != HTTPStatus.OK
+                or isinstance(result, BaseWebService.StreamingServiceResponse)):
+            return result
+
+        # FrozenServiceResponses are shared between requests, they're tagged as they're built
+        if (result.etag is None and web_service.auto_etag and result.payload
+                and not isinstance(result, BaseWebService.FrozenServiceResponse)):
+            result.etag = BaseWebService.make_etag(result.payload)
+
+        if result.etag and BaseWebService.etag_matches(result.etag, headers):
+            return BaseWebService.ServiceResponse(resp_code=HTTPStatus.NOT_MODIFIED, etag=result.etag)
+
+        return result
 
     def __get_web_service_that_owns_path(self, path, web_service_candidates, path_is_trimmed=False):
         """ Gets the web service that owns the path. If no web service owns the given path then the next available web
@@ -224,6 +1216,7 @@ class WebServiceController(object):
         web_services = list()
         for web_service in web_service_classes:
             instantiated_web_service = web_service()
+            instantiated_web_service.service_bus = self.service_bus
             if instantiated_web_service.enabled:
                 web_services.append(instantiated_web_service)
         return web_services
@@ -232,7 +1225,7 @@ class WebServiceController(object):
         """ Creates a fast lookup using a list of loaded (instantiated) web
             services.
         """
-        lookup = { 'GET' : dict(), 'POST' : dict(), 'PUT' : dict(), 'DELETE' : dict() }
+        lookup = {method: dict() for method in BaseWebService.HTTP_METHODS}
         for web_service in loaded_web_services:
             
             allowed_methods = web_service.get_allowed_http_methods()
@@ -243,38 +1236,55 @@ class WebServiceController(object):
         return lookup
             
     
-    def __server_run_thread(self):
+    def __server_run_thread(self, server):
         """ Blocking thread call which serves the HTTP server.
         """
         
         try:
             logging.info('Starting Server')
-            self.__server.serve_forever()
+            server.serve_forever()
             
             logging.debug('Confirmed, Server shutdown')
         except:
             logging.error('Failed to start server')
         finally:
-            self.__server.server_close()
+            server.server_close()
     
     def __start_server(self):
-        """ Starts the HTTP server on the configured port.
-        """
-        self._server_address = ('', self._port)
-        self.__server = ThreadedHTTPServer(self._server_address, HTTPRequestHandler)
-        # Set ourselves onto the server so it can callback to us
-        self.__server.RequestHandlerClass.set_controller(self)
-        sa = self.__server.socket.getsockname()
-        logging.info("Serving HTTP on port " + str(sa[1]))
-        
-        self.__server_thread = Thread(target=self.__server_run_thread)
-        self.__server_thread.start()
+        """ Starts the HTTP server on each of the configured addresses, all
+            sharing the one request handler class.
+        """
+        # Set ourselves onto the handler so it can callback to us
+        HTTPRequestHandler.set_controller(self)
+        HTTPRequestHandler.fast_header_parsing = self._fast_header_parsing
+        HTTPRequestHandler.configure_limits(**self._request_limits)
+
+        try:
+            for address in self._listen_addresses:
+                (server_class, server_address) = parse_listen_address(address)
+                server = server_class(server_address, HTTPRequestHandler, self._socket_options)
+                self.__servers.append(server)
+                logging.info('Serving HTTP on ' + str(server.socket.getsockname()))
+        except:
+            for server in self.__servers:
+                server.server_close()
+            self.__servers = list()
+            raise
+
+        for server in self.__servers:
+            server_thread = Thread(target=self.__server_run_thread, args=(server,))
+            server_thread.start()
+            self.__server_threads.append(server_thread)
             
     def __stop_server(self):
         """ Stops the HTTP server.
         """
         logging.info('Shutting down server...')
-        self.__server.shutdown()
-        self.__server_thread.join()
+        for server in self.__servers:
+            server.shutdown()
+        for server_thread in self.__server_threads:
+            server_thread.join()
+        self.__servers        = list()
+        self.__server_threads = list()
         logging.info('Server shutdown')
 
@@ -0,0 +1,122 @@
+
+import logging
+import threading
+
+from webcommon import diagnostics
+from webcommon.background_webservice import BaseBackgroundWebService
+from webcommon.base_webservice import BaseWebService, HTTPStatus
+from webcommon.json_response import JsonServiceResponse
+
+WEB_SERVICE_CONFIG = {BaseWebService.CONF_ITM_NAME: 'Diagnostics WebService',
+                      BaseWebService.CONF_ITM_ENABLED: 'true',
+                      BaseWebService.CONF_ITM_AUTH_ALL_ENABLED: 'true',
+                      BaseWebService.CONF_ITM_OWNED_URLS:
+                          {'/diagnostics':
+                              {BaseWebService.CONF_ITM_ALLOW_METH : ['GET', 'POST'],
+                               BaseWebService.CONF_ITM_FULL_MATCH_ONLY : 'false',
+                               BaseWebService.CONF_ITM_AUTH_BASIC_ENABLED: 'true',
+                               BaseWebService.CONF_ITM_AUTH_USERNAME: 'admin',
+                               BaseWebService.CONF_ITM_AUTH_PASSWORD: 'MySecretPassword'
+                              }
+                          }
+                     }
+
+
+class DiagnosticsWebService(BaseWebService):
+    """ Example WebService for finding out where the memory of a long-running
+        WSBlite goes. Every url returns JSON:
+
+        GET  /diagnostics                     - memory statistics of this process
+        GET  /diagnostics/threads             - every thread and its current stack
+        GET  /diagnostics/queues              - queue sizes of each background web service
+        GET  /diagnostics/background          - memory statistics of each background process
+        POST /diagnostics/tracemalloc/start   - start tracemalloc here and in every background process
+        POST /diagnostics/tracemalloc/stop    - stop it again
+        GET  /diagnostics/memory              - top allocation sites (tracemalloc must be started)
+        GET  /diagnostics/memory/diff         - allocation growth since the last diff
+
+        Take ?limit=N to change how many allocation sites are listed and
+        ?frames=N when starting tracemalloc to record deeper tracebacks.
+    """
+    def __init__(self):
+        super().__init__(WEB_SERVICE_CONFIG)
+        self.background_web_services = list()
+
+        self.__last_snapshot      = None
+        self.__last_snapshot_lock = threading.Lock()
+
+    def initialise(self, web_services_loaded):
+        self.background_web_services = [web_service for web_service in web_services_loaded
+                                        if isinstance(web_service, BaseBackgroundWebService)]
+
+    def perform_request(self, request):
+        action = request.path[len('/diagnostics'):].strip('/')
+        limit = self.__get_positive_int(request, 'limit', 10)
+        frames = self.__get_positive_int(request, 'frames', 1)
+        if limit is None or frames is None:
+            return self.RESPONSE_BAD_REQUEST
+
+        if request.method == 'POST' and action in ('tracemalloc/start', 'tracemalloc/stop'):
+            return JsonServiceResponse(self.__set_tracemalloc(action.split('/')[1], limit, frames))
+        if request.method != 'GET':
+            return self.RESPONSE_METHOD_NOT_ALLOWED
+
+        if action == '':
+            return JsonServiceResponse(diagnostics.process_stats(limit))
+        elif action == 'threads':
+            return JsonServiceResponse(diagnostics.thread_stacks())
+        elif action == 'queues':
+            return JsonServiceResponse({web_service.service_name: web_service.get_queue_sizes()
+                                        for web_service in self.background_web_services})
+        elif action == 'background':
+            return JsonServiceResponse({web_service.service_name: web_service.get_process_stats(limit)
+                                        for web_service in self.background_web_services})
+        elif action == 'memory':
+            snapshot = diagnostics.take_snapshot()
+            if snapshot is None:
+                return self.__tracemalloc_not_started()
+            return JsonServiceResponse(diagnostics.top_allocations(snapshot, limit))
+        elif action == 'memory/diff':
+            snapshot = diagnostics.take_snapshot()
+            if snapshot is None:
+                return self.__tracemalloc_not_started()
+            with self.__last_snapshot_lock:
+                (previous, self.__last_snapshot) = (self.__last_snapshot, snapshot)
+            # The first diff only records where to compare from
+            return JsonServiceResponse(diagnostics.compare_snapshots(previous, snapshot, limit) if previous else [])
+
+        return self.RESPONSE_NOT_FOUND
+
+    def start(self):
+        logging.info('DiagnosticsWebService Start')
+
+    def stop(self):
+        diagnostics.stop_tracemalloc()
+        logging.info('DiagnosticsWebService Stop')
+
+    def __set_tracemalloc(self, tracemalloc_action, limit, frames):
+        if tracemalloc_action == 'start':
+            diagnostics.start_tracemalloc(frames)
+        else:
+            diagnostics.stop_tracemalloc()
+            with self.__last_snapshot_lock:
+                self.__last_snapshot = None
+
+        result = {'tracing': tracemalloc_action == 'start', 'background': dict()}
+        for web_service in self.background_web_services:
+            stats = web_service.get_process_stats(limit, tracemalloc_action, tracemalloc_frames=frames)
+            result['background'][web_service.service_name] = stats['tracemalloc']['tracing'] if stats else None
+        return result
+
+    @staticmethod
+    def __get_positive_int(request, name, default):
+        # None if the query parameter isn't a whole number of at least 1
+        try:
+            value = int(request.get_query_param(name, default))
+        except ValueError:
+            return None
+        return value if value >= 1 else None
+
+    def __tracemalloc_not_started(self):
+        return self.ServiceResponse(payload='tracemalloc is not started, POST to /diagnostics/tracemalloc/start',
+                                    resp_code=HTTPStatus.CONFLICT, add_html_wrapper=False, content_type='text/plain')
@@ -3,12 +3,15 @@ import logging
 
 from random import randint
 from webcommon.background_webservice import BaseWebService, BaseBackgroundWebService
-from time import sleep
 
 WEB_SERVICE_CONFIG = {BaseWebService.CONF_ITM_NAME: 'Random Number Generator',
                          BaseWebService.CONF_ITM_ENABLED: 'true',
+                         BaseBackgroundWebService.CONF_ITM_AUTO_RESTART: 'true',
                          BaseWebService.CONF_ITM_OWNED_URLS:
                              {'/random_number':
+                                 {BaseWebService.CONF_ITM_ALLOW_METH : ['GET'],
+                                  BaseWebService.CONF_ITM_FULL_MATCH_ONLY: 'true'},
+                              '/random_number/events':
                                  {BaseWebService.CONF_ITM_ALLOW_METH : ['GET'],
                                   BaseWebService.CONF_ITM_FULL_MATCH_ONLY: 'true'}
                              }
@@ -47,20 +50,21 @@ class RandomNumWebService(BaseBackgroundWebService):
 
         def initialise(self):
             """ Any setup work or initialising member variables needs to happen in
-                this method.
+                this method. Here we also schedule a new random number to be
+                generated straight away and then every 5 seconds.
             """
             self.__random_number_generated = 0
+            self.schedule_fixed_rate(5, self.generate_random_number, initial_delay=0)
 
-        def loop(self):
-            """ This method generates a new random number and is called as soon
-                as it exits. Allowing the method to exit before it is re-called
-                gives the WebService a chance to see if it has been told to stop
-                and therefore blocking here means it may be terminated without
-                notice.
+        def generate_random_number(self):
+            """ This method generates a new random number and is called every few
+                seconds by the scheduler. As we don't override loop, the background
+                process sleeps in between and stops as soon as it is told to.
             """
             self.__random_number_generated = randint(1, 100)
             logging.info("Latest random number: " + str(self.__random_number_generated))
-            sleep(5)
+            # Push the new number to any clients subscribed to /random_number/events
+            self.publish(self.__random_number_generated, event='random_number')
 
         def deinitialise(self):
             """ Any resources owned can be released here before the process exits
@@ -88,15 +92,24 @@ class RandomNumWebService(BaseBackgroundWebService):
         super().__init__(WEB_SERVICE_CONFIG, self.RandomNumBackgroundProcess)
 
 
-    def perform_client_request(self, handler, method, path, headers, payload_type, payload_content):
+    def perform_request(self, request):
         """ When a client requests for a random number, we inform the background
             process of this request and block until we get the result for the 
             client. We pass a message to the background process so it knows what
             we're asking for. We define the message and handle it in the
             background process with handle_request so the message can be anything
             so long as we handle it on the other side.
+
+            Clients requesting the events url are instead kept connected and
+            sent every new number as it is generated, saving them from polling.
         """
+        if request.path == '/random_number/events':
+            return self.subscribe_to_events()
+
         answer = self.request(self.RandomNumBackgroundProcess.REQUEST_RANDOM_NUM)
+        if answer is None:
+            # The background process didn't reply in time
+            return self.RESPONSE_SERVICE_UNAVAILABLE
 
         return self.ServiceResponse(payload=str(answer))
 
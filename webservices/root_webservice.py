@@ -1,7 +1,7 @@
 
 import logging
 
-from webcommon.base_webservice import BaseWebService
+from webcommon.base_webservice import BaseWebService, HTTPStatus
 
 WEB_SERVICE_CONFIG = {BaseWebService.CONF_ITM_NAME: 'Root',
                          BaseWebService.CONF_ITM_ENABLED: 'true',
@@ -22,9 +22,16 @@ class RootWebService(BaseWebService):
     def __init__(self):
         super().__init__(WEB_SERVICE_CONFIG)
         self.html_body = ''
+        self.html_etag = None
     
-    def perform_client_request(self, handler, method, path, headers, payload_type, payload_content):
-        return self.ServiceResponse(payload=self.html_body)
+    def perform_request(self, request):
+        """ The page never changes once started, so clients that already hold it
+            are told so without the page being sent again.
+        """
+        if self.etag_matches(self.html_etag, request.headers):
+            return self.ServiceResponse(resp_code=HTTPStatus.NOT_MODIFIED, etag=self.html_etag)
+
+        return self.ServiceResponse(payload=self.html_body, etag=self.html_etag)
     
     def initialise(self, web_services_loaded):
         """ At initialisation we get a sneaky look at other web services running
@@ -43,6 +50,7 @@ class RootWebService(BaseWebService):
 
     
     def start(self):
+        self.html_etag = self.make_etag(self.html_body)
         logging.info('RootWebService Start')
         logging.info(self.html_body)
     
@@ -0,0 +1,41 @@
+
+import logging
+
+from webcommon import tracing
+from webcommon.base_webservice import BaseWebService
+from webcommon.json_response import JsonServiceResponse
+
+WEB_SERVICE_CONFIG = {BaseWebService.CONF_ITM_NAME: 'Trace Viewer WebService',
+                      BaseWebService.CONF_ITM_ENABLED: 'true',
+                      BaseWebService.CONF_ITM_AUTH_ALL_ENABLED: 'true',
+                      BaseWebService.CONF_ITM_OWNED_URLS:
+                          {'/traces':
+                              {BaseWebService.CONF_ITM_ALLOW_METH : ['GET'],
+                               BaseWebService.CONF_ITM_FULL_MATCH_ONLY : 'true',
+                               BaseWebService.CONF_ITM_AUTH_BASIC_ENABLED: 'true',
+                               BaseWebService.CONF_ITM_AUTH_USERNAME: 'admin',
+                               BaseWebService.CONF_ITM_AUTH_PASSWORD: 'MySecretPassword'
+                              }
+                          }
+                     }
+
+
+class TraceViewerWebService(BaseWebService):
+    """ Example WebService which returns the most recent request traces as JSON,
+        newest first. Each trace is a list of spans (header parsing, routing,
+        authentication, the web service's own work, background process requests
+        and writing the response) with their durations in milliseconds.
+
+        Nothing is traced unless WSBlite is run with --trace_sample_rate.
+    """
+    def __init__(self):
+        super().__init__(WEB_SERVICE_CONFIG)
+
+    def perform_request(self, request):
+        return JsonServiceResponse(tracing.ring_buffer.get_traces(), default=str)
+
+    def start(self):
+        logging.info('TraceViewerWebService Start')
+
+    def stop(self):
+        logging.info('TraceViewerWebService Stop')